@@ -1,20 +1,30 @@
+# Started first so the timing report includes the imports of a cold start
+import time
+SCRIPT_STARTED = time.perf_counter()
+
 import streamlit as st
 import pandas as pd
+import numpy as np
 import json
-import requests
-from concurrent.futures import ThreadPoolExecutor
+import tracemalloc
 from io import BytesIO
 from datetime import datetime
 import sqlite3
+import importlib.util
 import os
 
-# Check if folium is available
-try:
-    import folium
-    from streamlit_folium import st_folium
-    FOLIUM_AVAILABLE = True
-except ImportError:
-    FOLIUM_AVAILABLE = False
+import db
+from core import (
+    FTS5_AVAILABLE, API_MAX_WORKERS, API_RATE_LIMIT, EXPORT_FORMATS,
+    run_timings, stage_timings, metrics, prometheus_metrics, load_module,
+    init_database, get_library, update_library_in_db, get_history, state_as_of, system_changes,
+    search_libraries, json_to_dataframe, get_fylke_name, rank_search_hits, rank_substring_hits,
+    map_points, create_map, create_deck,
+    StatsCube, SharedDataset, JobRunner, ACTIVE_JOB_STATES, get_job, cancel_job
+)
+
+# Check if folium is available; it is only imported when the map is shown
+FOLIUM_AVAILABLE = all(importlib.util.find_spec(name) is not None for name in ['folium', 'streamlit_folium'])
 
 # Page configuration
 st.set_page_config(
@@ -55,160 +65,69 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-# Database functions
-def init_database(db_path="bibliotek.db"):
-    """Initialize SQLite database"""
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    # Create main table
-    c.execute('''CREATE TABLE IF NOT EXISTS bibliotek
-                 (rid INTEGER PRIMARY KEY,
-                  bibnr TEXT UNIQUE,
-                  data TEXT)''')
-    
-    conn.commit()
-    return conn
+# Shared dataset and historical states, cached per process
+@st.cache_resource(show_spinner=False)
+def shared_dataset(db_path):
+    return SharedDataset(db_path)
 
-def save_to_database(data, db_path="bibliotek.db"):
-    """Save library data to database"""
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    for lib in data:
-        rid = lib.get('rid')
-        bibnr = lib.get('bibnr')
-        data_json = json.dumps(lib, ensure_ascii=False)
-        
-        c.execute('''INSERT OR REPLACE INTO bibliotek (rid, bibnr, data)
-                     VALUES (?, ?, ?)''', (rid, bibnr, data_json))
-    
-    conn.commit()
-    conn.close()
-    return True
-
-def load_from_database(db_path="bibliotek.db"):
-    """Load library data from database"""
-    if not os.path.exists(db_path):
-        return None
-    
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    c.execute('SELECT data FROM bibliotek')
-    rows = c.fetchall()
-    conn.close()
-    
-    data = [json.loads(row[0]) for row in rows]
-    return data
+@st.cache_data(max_entries=8, show_spinner="Henter historisk tilstand...")
+def dataset_as_of(changed_at, data_version, db_path="bibliotek.db"):
+    """Frame of every library as it was at `changed_at`; data_version is only part of the cache key"""
+    libs = state_as_of(changed_at, db_path)
+    return json_to_dataframe(libs) if libs else None
 
-def update_library_in_db(bibnr, updated_data, db_path="bibliotek.db"):
-    """Update a single library in database"""
-    conn = sqlite3.connect(db_path)
-    c = conn.cursor()
-    
-    data_json = json.dumps(updated_data, ensure_ascii=False)
-    c.execute('UPDATE bibliotek SET data = ? WHERE bibnr = ?', (data_json, bibnr))
-    
-    conn.commit()
-    conn.close()
-
-# Helper functions
-def json_to_dataframe(data):
-    """Convert JSON data to pandas DataFrame"""
-    records = []
-    for lib in data:
-        record = {
-            'rid': lib.get('rid'),
-            'bibnr': lib.get('bibnr'),
-            'bibliotek': lib.get('inst', '').split('\n')[0] if lib.get('inst') else '',
-            'bibliotek_full': lib.get('inst'),
-            'biblioteksystem': lib.get('katsyst'),
-            'bibliotektype': lib.get('bibltype'),
-            'kommunenr': lib['kommnr'].get('kommnr') if lib.get('kommnr') else None,
-            'kommune_navn': lib['kommnr'].get('navn') if lib.get('kommnr') else None,
-            'adresse': lib.get('vadr'),
-            'postnr': lib.get('vpostnr'),
-            'poststed': lib.get('vpoststed'),
-            'epost': lib.get('epostAdr'),
-            'telefon': lib.get('tlf'),
-            'nettside': lib.get('urlHjem'),
-            'katalog': lib.get('urlKat'),
-            'lat_lon': lib.get('lat_lon'),
-            'orgnr': lib.get('orgnr'),
-            'bibleder': lib.get('bibleder'),
-            'isil': lib.get('isil'),
-            'raw_data': lib
-        }
-        
-        if record['lat_lon']:
-            try:
-                parts = record['lat_lon'].split(',')
-                record['lat'] = float(parts[0].strip())
-                record['lon'] = float(parts[1].strip())
-            except:
-                record['lat'] = None
-                record['lon'] = None
-        else:
-            record['lat'] = None
-            record['lon'] = None
-        
-        if record['kommunenr']:
-            try:
-                record['fylke_nr'] = record['kommunenr'][:2]
-            except:
-                record['fylke_nr'] = None
-        else:
-            record['fylke_nr'] = None
-        
-        records.append(record)
-    
-    return pd.DataFrame(records)
+# Background jobs, run by one runner per process so they outlive reruns and sessions
+JOB_POLL_SECONDS = 1.0
 
-FYLKE_MAPPING = {
-    '03': 'Oslo', '11': 'Rogaland', '15': 'Møre og Romsdal', '18': 'Nordland',
-    '32': 'Akershus', '31': 'Østfold', '33': 'Buskerud', '34': 'Innlandet', '39': 'Vestfold', '40': 'Telemark',
-    '42': 'Agder', '46': 'Vestland', '50': 'Trøndelag', '55': 'Troms', '56': 'Finnmark',
-}
+@st.cache_resource(show_spinner=False)
+def job_runner(db_path):
+    return JobRunner(db_path)
 
-def get_fylke_name(fylke_nr):
-    return FYLKE_MAPPING.get(fylke_nr, f"Fylke {fylke_nr}")
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress(job_id, text):
+    """Progress bar and cancel button of a running job, polled without rerunning the page"""
+    job = get_job(job_id, st.session_state.db_path)
+    if job is None or job['status'] not in ACTIVE_JOB_STATES:
+        # Rerun the whole page to show the result
+        st.rerun()
+    st.progress(job['progress'], text=job['message'] or text)
+    if job['cancel_requested']:
+        st.caption("Avbryter...")
+    elif st.button("⏹️ Avbryt", key=f"cancel_job_{job_id}"):
+        cancel_job(job_id, st.session_state.db_path)
 
-def create_map(df_filtered):
-    if not FOLIUM_AVAILABLE:
+def show_job(key, text):
+    """Follow the job whose id is in st.session_state[key]; returns the job once it has finished"""
+    job_id = st.session_state.get(key)
+    job = get_job(job_id, st.session_state.db_path) if job_id is not None else None
+    if job is None:
         return None
-    
-    df_map = df_filtered[df_filtered['lat'].notna() & df_filtered['lon'].notna()].copy()
-    if len(df_map) == 0:
+    if job['status'] in ACTIVE_JOB_STATES:
+        show_job_progress(job_id, text)
         return None
-    
-    center_lat = df_map['lat'].mean()
-    center_lon = df_map['lon'].mean()
-    
-    m = folium.Map(location=[center_lat, center_lon], zoom_start=6, tiles='OpenStreetMap')
-    
-    for _, row in df_map.iterrows():
-        popup_text = f"<b>{row['bibliotek']}</b><br>Type: {row['bibliotektype']}<br>System: {row['biblioteksystem']}<br>{row['poststed']}"
-        folium.Marker(
-            location=[row['lat'], row['lon']],
-            popup=folium.Popup(popup_text, max_width=250),
-            tooltip=row['bibliotek'],
-            icon=folium.Icon(color='blue', icon='book', prefix='fa')
-        ).add_to(m)
-    
-    return m
+    if job['status'] == 'failed':
+        st.error(f"Feil: {job['error']}")
+    elif job['status'] == 'cancelled':
+        st.warning("Jobben ble avbrutt")
+    return job
 
-def export_to_excel(df):
+# Folium maps, cached per set of points
+@st.cache_resource(max_entries=16, show_spinner=False)
+def cached_map(points):
+    return create_map(points)
+
+# Export files, cached per frame and format
+@st.cache_data(max_entries=8, show_spinner="Lager eksportfil...")
+def export_file(df, export_format, full_records=False, data_version=None, db_path="bibliotek.db"):
+    """Export df in the given format and return the file bytes, cached per frame and format
+
+    data_version is only part of the cache key, so full-record exports are
+    redone when child rows change without the frame changing.
+    """
+    writer, _, _, supports_full = EXPORT_FORMATS[export_format]
     output = BytesIO()
-    export_cols = ['bibnr', 'bibliotek', 'biblioteksystem', 'bibliotektype', 'kommunenr', 
-                   'kommune_navn', 'fylke_nr', 'adresse', 'postnr', 'poststed',
-                   'epost', 'telefon', 'nettside', 'katalog', 'lat_lon', 'orgnr', 'bibleder', 'isil']
-    
-    df_export = df[export_cols].copy()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df_export.to_excel(writer, sheet_name='Bibliotekdata', index=False)
-    
-    output.seek(0)
-    return output
+    writer(df, output, db_path if full_records and supports_full else None)
+    return output.getvalue()
 
 def show_library_details(lib_data, edit_mode=False):
     """Show detailed information about a library with optional edit mode"""
@@ -255,24 +174,23 @@ def show_library_details(lib_data, edit_mode=False):
                 updated_data['bibleder'] = new_bibleder
                 updated_data['lat_lon'] = new_lat_lon
                 
-                # Save to database
-                update_library_in_db(lib_data.get('bibnr'), updated_data)
-                
-                # Update session state
-                for i, lib in enumerate(st.session_state.data):
-                    if lib.get('bibnr') == lib_data.get('bibnr'):
-                        st.session_state.data[i] = updated_data
-                        break
-                
-                st.session_state.df = json_to_dataframe(st.session_state.data)
-                st.success("✅ Endringer lagret!")
-                st.rerun()
+                # Save to database and patch the edited row into the shared frame
+                try:
+                    version = update_library_in_db(lib_data.get('bibnr'), updated_data, st.session_state.db_path)
+                except KeyError:
+                    st.error("Biblioteket finnes ikke lenger i databasen")
+                except sqlite3.Error as e:
+                    st.error(f"Feil ved lagring: {str(e)}")
+                else:
+                    shared_dataset(st.session_state.db_path).apply_edit(updated_data, version)
+                    st.success("✅ Endringer lagret!")
+                    st.rerun()
         
         st.markdown('</div>', unsafe_allow_html=True)
     
     else:
         # View mode with tabs
-        tab1, tab2, tab3, tab4 = st.tabs(["📋 Grunninfo", "📞 Kontakt", "🔗 Ressurser", "📝 Merknader"])
+        tab1, tab2, tab3, tab4, tab5 = st.tabs(["📋 Grunninfo", "📞 Kontakt", "🔗 Ressurser", "📝 Merknader", "🕓 Historikk"])
         
         with tab1:
             col1, col2, col3 = st.columns(3)
@@ -372,17 +290,108 @@ def show_library_details(lib_data, edit_mode=False):
                         st.write(merknad.get('tekst', ''))
             else:
                 st.info("Ingen merknader registrert")
+        
+        with tab5:
+            versions = get_history(lib_data.get('bibnr'), st.session_state.db_path)
+            if versions:
+                kinds = {'full': "Fullstendig kopi", 'diff': "Endring", 'deleted': "Slettet"}
+                st.dataframe(pd.DataFrame({
+                    'Versjon': [v['seq'] for v in versions],
+                    'Tidspunkt': [v['changed_at'] for v in versions],
+                    'Lagret som': [kinds[v['kind']] for v in versions],
+                    'Endrede felt': [', '.join(v['changed']) for v in versions]
+                }).iloc[::-1], use_container_width=True, hide_index=True)
+            else:
+                st.info("Ingen historikk registrert")
 
-# Initialize session state
-if 'data' not in st.session_state:
-    st.session_state.data = None
-if 'df' not in st.session_state:
-    st.session_state.df = None
+def show_api_fetch():
+    """Fetch library records from the BaseBibliotek API for a CSV of bibnr values"""
+    st.markdown("## 🔄 Hent data fra API")
+    st.info("Her kan du hente nye data fra BaseBibliotek API. Du trenger en CSV-fil med biblioteknumre.")
+    
+    csv_file = st.file_uploader("Last opp CSV", type=['csv'], key="csv_uploader")
+    
+    if csv_file:
+        try:
+            df_bibnr = pd.read_csv(csv_file, header=None, names=['bibnr'])
+            bibnr_list = df_bibnr['bibnr'].astype(str).tolist()
+            st.success(f"Fant {len(bibnr_list)} biblioteknumre")
+
+            col1, col2 = st.columns(2)
+            with col1:
+                max_workers = st.number_input("Samtidige forespørsler", min_value=1, max_value=64, value=API_MAX_WORKERS)
+                incremental = st.checkbox("Inkrementell synk (skriv kun nye og endrede bibliotek)", value=True)
+            with col2:
+                rate_limit = st.number_input("Maks forespørsler per sekund (0 = ubegrenset)", min_value=0.0, value=API_RATE_LIMIT, step=10.0)
+                remove_missing = st.checkbox("Slett bibliotek som ikke finnes i CSV-filen", value=False, disabled=not incremental)
+
+            if st.button("🚀 Start datahenting", type="primary"):
+                job_id, created = job_runner(st.session_state.db_path).submit_sync(
+                    bibnr_list,
+                    max_workers=int(max_workers),
+                    rate_limit=rate_limit,
+                    incremental=incremental,
+                    remove_missing=remove_missing
+                )
+                st.session_state.sync_job = job_id
+                if not created:
+                    st.info("Den samme datahentingen kjører allerede, viser fremdriften")
+        except Exception as e:
+            st.error(f"Feil: {str(e)}")
+    
+    # Outside the CSV block, so a sync keeps showing after the upload is cleared
+    job = show_job('sync_job', "Starter datahenting...")
+    if job and job['status'] == 'done':
+        show_sync_result(job['result'])
+
+def show_sync_result(result):
+    """Counts, changed bibnr values and request errors of a finished API sync"""
+    if result['incremental']:
+        report = result['report']
+        data_changed = bool(report['added'] or report['changed'] or (result['remove_missing'] and report['removed']))
+        st.success(f"✅ Synk fullført på {result['seconds']:.1f} s")
+
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Nye", len(report['added']))
+        col2.metric("Endrede", len(report['changed']))
+        col3.metric("Uendrede", len(report['unchanged']))
+        col4.metric("Slettet" if result['remove_missing'] else "Mangler i CSV", len(report['removed']))
+
+        for label, key in [("Nye", 'added'), ("Endrede", 'changed'), ("Mangler i CSV", 'removed')]:
+            if report[key]:
+                with st.expander(f"{label} ({len(report[key])})"):
+                    st.write(", ".join(report[key]))
+    else:
+        data_changed = bool(result['saved'])
+        if data_changed:
+            st.success(f"✅ Hentet {result['saved']} bibliotek på {result['seconds']:.1f} s")
+
+    if data_changed:
+        st.session_state.dataset_loaded = True
+    if result['errors']:
+        st.warning(f"⚠️ {len(result['errors'])} forespørsler feilet")
+        with st.expander("Vis feil"):
+            st.dataframe(
+                pd.DataFrame(list(result['errors'].items()), columns=['Bibnr', 'Feil']),
+                use_container_width=True,
+                hide_index=True
+            )
+
+# Initialize session state; the dataset itself is shared, see SharedDataset
+if 'dataset_loaded' not in st.session_state:
+    st.session_state.dataset_loaded = False
 if 'db_path' not in st.session_state:
     st.session_state.db_path = "bibliotek.db"
 
-# Initialize database
-init_database(st.session_state.db_path)
+# Initialize database once per file; a deleted or replaced file is initialized again
+@st.cache_resource(show_spinner=False)
+def ensure_database(db_path, file_id):
+    init_database(db_path)
+
+if not os.path.exists(st.session_state.db_path):
+    # Not cached, or a later deletion would hit this entry again
+    init_database(st.session_state.db_path)
+ensure_database(st.session_state.db_path, db.get_pool(st.session_state.db_path).current_file_id())
 
 # Main app
 st.markdown("# 📚 Norske Bibliotek")
@@ -402,11 +411,10 @@ with st.sidebar:
     
     if data_source == "Last fra database":
         if st.button("📂 Last fra database", use_container_width=True):
-            data = load_from_database(st.session_state.db_path)
-            if data:
-                st.session_state.data = data
-                st.session_state.df = json_to_dataframe(data)
-                st.success(f"✅ Lastet {len(data)} bibliotek fra database")
+            df = shared_dataset(st.session_state.db_path).get()
+            if df is not None:
+                st.session_state.dataset_loaded = True
+                st.success(f"✅ Lastet {len(df)} bibliotek fra database")
             else:
                 st.warning("Ingen data i database. Last opp JSON først.")
     
@@ -417,19 +425,33 @@ with st.sidebar:
             help="Last opp bib_data.json-filen"
         )
         
-        if uploaded_file is not None:
+        # The uploader keeps the file across reruns, so submit each upload only once;
+        # the import runs in the background and any session can follow it
+        if uploaded_file is not None and st.session_state.get('ingested_file') != uploaded_file.file_id:
             try:
-                data = json.load(uploaded_file)
-                st.session_state.data = data
-                st.session_state.df = json_to_dataframe(data)
-                
-                # Save to database
-                save_to_database(data, st.session_state.db_path)
-                
-                st.success(f"✅ Lastet {len(data)} bibliotek")
-                st.info("💾 Data lagret i database")
+                job_id, created = job_runner(st.session_state.db_path).submit_import(uploaded_file, uploaded_file.name)
+                st.session_state.import_job = job_id
+                st.session_state.ingested_file = uploaded_file.file_id
+                if not created:
+                    st.info("Filen importeres allerede, viser fremdriften")
             except Exception as e:
                 st.error(f"Feil ved lasting: {str(e)}")
+        
+        if uploaded_file is not None and st.session_state.get('ingested_file') == uploaded_file.file_id:
+            job = show_job('import_job', "Leser JSON...")
+            report = job['result'] if job and job['status'] == 'done' else None
+            if report:
+                st.session_state.dataset_loaded = True
+                if report['previous']:
+                    st.info(f"Filen ble allerede importert {report['previous']['imported_at']} "
+                            f"({report['previous']['saved']} bibliotek)")
+                else:
+                    st.success(f"✅ Lastet {report['saved']} bibliotek")
+                    st.info("💾 Data lagret i database")
+                if report['skipped']:
+                    st.warning(f"⚠️ Hoppet over {report['skipped']} ugyldige poster")
+                    for error in report['errors']:
+                        st.caption(error)
     
     st.markdown("---")
 
@@ -439,23 +461,26 @@ selected_bibltype = []
 selected_katsyst = []
 search_term = ""
 
-if st.session_state.df is not None:
-    df = st.session_state.df
+dataset = shared_dataset(st.session_state.db_path)
+df = dataset.get() if st.session_state.dataset_loaded else None
+
+if df is not None:
+    filters = dataset.filters(df)
     
     with st.sidebar:
         st.markdown("### 🔍 Filtrer data")
         
-        fylke_options = sorted(df['fylke_nr'].dropna().unique())
+        fylke_options = filters.options['fylke_nr']
         selected_fylke = st.selectbox(
             "Fylke",
             options=[None] + fylke_options,
             format_func=lambda x: "Alle fylker" if x is None else f"{get_fylke_name(x)} ({x})"
         )
         
-        bibltype_options = sorted(df['bibliotektype'].dropna().unique())
+        bibltype_options = filters.options['bibliotektype']
         selected_bibltype = st.multiselect("Bibliotektype", options=bibltype_options, default=bibltype_options)
         
-        katsyst_options = sorted(df['biblioteksystem'].dropna().unique())
+        katsyst_options = filters.options['biblioteksystem']
         selected_katsyst = st.multiselect("Biblioteksystem", options=katsyst_options, default=katsyst_options)
         
         search_term = st.text_input("🔎 Søk", placeholder="Søk i alle felt...")
@@ -463,55 +488,85 @@ if st.session_state.df is not None:
         st.markdown("---")
         st.markdown("### 💾 Eksporter")
     
-    # Apply filters
-    df_filtered = df.copy()
-    
-    if selected_fylke:
-        df_filtered = df_filtered[df_filtered['fylke_nr'] == selected_fylke]
-    if selected_bibltype:
-        df_filtered = df_filtered[df_filtered['bibliotektype'].isin(selected_bibltype)]
-    if selected_katsyst:
-        df_filtered = df_filtered[df_filtered['biblioteksystem'].isin(selected_katsyst)]
-    if search_term:
-        mask = df_filtered.apply(lambda row: row.astype(str).str.contains(search_term, case=False, na=False).any(), axis=1)
-        df_filtered = df_filtered[mask]
+    # Apply filters from the precomputed facet masks; df itself is never modified
+    with stage_timings().stage('filter'):
+        df_filtered = df[filters.mask(selected_fylke, selected_bibltype, selected_katsyst)]
+        
+        if search_term:
+            if FTS5_AVAILABLE:
+                df_filtered = rank_search_hits(df_filtered, search_libraries(search_term, st.session_state.db_path))
+            else:
+                mask = df_filtered.apply(lambda row: row.astype(str).str.contains(search_term, case=False, na=False).any(), axis=1)
+                df_filtered = df_filtered[mask]
     
     with st.sidebar:
-        if st.button("📥 Last ned Excel", use_container_width=True):
-            excel_file = export_to_excel(df_filtered)
+        st.markdown("### 📥 Eksport")
+        export_format = st.selectbox("Format", options=list(EXPORT_FORMATS))
+        _, extension, mime, supports_full = EXPORT_FORMATS[export_format]
+        full_records = st.checkbox("Fullstendige poster", disabled=not supports_full,
+                                   help="Legger ressurser, alternative koder og merknader i egne ark")
+        
+        # The file is built on request and stays available until the filters or data change
+        export_key = (export_format, full_records and supports_full, dataset.version,
+                      selected_fylke, tuple(selected_bibltype), tuple(selected_katsyst), search_term)
+        if st.button("📥 Lag eksportfil", use_container_width=True):
+            st.session_state.export_key = export_key
+        if st.session_state.get('export_key') == export_key:
             st.download_button(
                 label="⬇️ Last ned",
-                data=excel_file,
-                file_name=f"bibliotekdata_{datetime.now().strftime('%Y%m%d')}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                data=export_file(df_filtered, export_format, export_key[1], dataset.version, st.session_state.db_path),
+                file_name=f"bibliotekdata_{datetime.now().strftime('%Y%m%d')}.{extension}",
+                mime=mime,
+                on_click='ignore',
                 use_container_width=True
             )
     
-    # Tabs
-    tab1, tab2, tab3, tab4 = st.tabs(["📊 Oversikt", "🔍 Søk bibliotek", "🗺️ Kart", "🔄 API"])
+    # Views; unlike st.tabs, only the selected view runs, so the map and its
+    # imports cost nothing until it is opened
+    views = ["📊 Oversikt", "🔍 Søk bibliotek", "🗺️ Kart", "🕓 Historikk", "🔄 API"]
+    view = st.radio("Visning", views, horizontal=True, key="view", label_visibility="collapsed")
+    view_started = time.perf_counter()
     
-    with tab1:
+    if view == views[0]:
         st.markdown("## 📊 Biblioteksoversikt")
         
+        # Search hits can't be expressed as cube cells, so they get a cube of their own
+        if search_term:
+            stats = StatsCube.from_frame(df_filtered)
+        else:
+            stats = dataset.stats(df).select(selected_fylke, selected_bibltype, selected_katsyst)
+        summary = stats.summary()
+        
         col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("Totalt antall", len(df_filtered))
+            st.metric("Totalt antall", summary['antall'])
         with col2:
-            st.metric("Bibliotektyper", df_filtered['bibliotektype'].nunique())
+            st.metric("Bibliotektyper", summary['bibliotektyper'])
         with col3:
-            st.metric("Biblioteksystemer", df_filtered['biblioteksystem'].nunique())
+            st.metric("Biblioteksystemer", summary['biblioteksystemer'])
         with col4:
-            st.metric("Med koordinater", df_filtered['lat'].notna().sum())
+            st.metric("Med koordinater", summary['med_koordinater'])
         
         st.markdown("---")
         
         col1, col2 = st.columns(2)
         with col1:
             st.markdown("#### 📈 Fordeling per type")
-            st.bar_chart(df_filtered['bibliotektype'].value_counts())
+            st.bar_chart(stats.counts('bibliotektype'))
         with col2:
             st.markdown("#### 💻 Fordeling per system")
-            st.bar_chart(df_filtered['biblioteksystem'].value_counts())
+            st.bar_chart(stats.counts('biblioteksystem'))
+        
+        breakdown1, breakdown2, breakdown3 = st.tabs(["🗺️ Per fylke", "🏘️ Per kommune", "🥧 Systemandel per type"])
+        with breakdown1:
+            st.bar_chart(stats.by_fylke())
+        with breakdown2:
+            kommuner = stats.by_kommune().set_axis(['Kommunenr', 'Kommune', 'Fylke', 'Antall', 'Med koordinater'], axis=1)
+            st.dataframe(kommuner, use_container_width=True, hide_index=True)
+        with breakdown3:
+            share = stats.market_share()
+            st.dataframe(share, use_container_width=True,
+                         column_config={str(col): st.column_config.NumberColumn(format="%.0f %%") for col in share.columns})
         
         st.markdown("---")
         st.markdown(f"#### 📚 Bibliotekliste ({len(df_filtered)} bibliotek)")
@@ -524,7 +579,7 @@ if st.session_state.df is not None:
         if hasattr(event, 'selection') and len(event.selection.rows) > 0:
             selected_idx = event.selection.rows[0]
             selected_lib_row = df_filtered.iloc[selected_idx]
-            selected_lib_data = selected_lib_row['raw_data']
+            selected_lib_data = get_library(selected_lib_row['bibnr'], st.session_state.db_path)
             
             st.markdown("---")
             st.markdown(f"### 📖 {selected_lib_row['bibliotek']}")
@@ -535,64 +590,160 @@ if st.session_state.df is not None:
             
             show_library_details(selected_lib_data, edit_mode=edit_mode)
     
-    with tab2:
+    elif view == views[1]:
         st.markdown("## 🔍 Søk etter bibliotek")
         
         search_query = st.text_input("Søk etter bibliotek (navn, bibnr, kommune...)", placeholder="Skriv for å søke...")
         
         if search_query:
-            # Search in all relevant fields
-            search_results = df[
-                df['bibliotek'].str.contains(search_query, case=False, na=False) |
-                df['bibnr'].str.contains(search_query, case=False, na=False) |
-                df['kommune_navn'].str.contains(search_query, case=False, na=False) |
-                df['poststed'].str.contains(search_query, case=False, na=False)
-            ]
+            # Ranked hits, best match first
+            if FTS5_AVAILABLE:
+                search_results = rank_search_hits(df, search_libraries(search_query, st.session_state.db_path))
+            else:
+                search_results = rank_substring_hits(df, search_query)
             
             st.info(f"Fant {len(search_results)} treff")
             
-            for idx, row in search_results.iterrows():
-                with st.expander(f"📚 {row['bibliotek']} ({row['bibnr']})"):
-                    col1, col2 = st.columns([6, 1])
-                    with col2:
-                        if st.button("✏️ Rediger", key=f"edit_{row['bibnr']}", use_container_width=True):
-                            st.session_state[f"edit_mode_{row['bibnr']}"] = True
-                    
-                    edit_mode = st.session_state.get(f"edit_mode_{row['bibnr']}", False)
-                    show_library_details(row['raw_data'], edit_mode=edit_mode)
+            if len(search_results) > 0:
+                # Only one page of hits is rendered, and details only for the selected hit
+                col1, col2 = st.columns([1, 1])
+                with col1:
+                    page_size = st.selectbox("Treff per side", options=[10, 25, 50, 100], index=1, key="search_page_size")
+                pages = (len(search_results) - 1) // page_size + 1
+                if st.session_state.get('search_page_query') != search_query:
+                    st.session_state.search_page_query = search_query
+                    st.session_state.search_page = 1
+                st.session_state.search_page = min(st.session_state.get('search_page', 1), pages)
+                with col2:
+                    page = st.number_input(f"Side (av {pages})", min_value=1, max_value=pages, key="search_page")
+                
+                page_results = search_results.iloc[(page - 1) * page_size:page * page_size]
+                selected_bibnr = st.radio(
+                    "Treff",
+                    options=page_results['bibnr'].tolist(),
+                    format_func=dict(zip(page_results['bibnr'],
+                                         "📚 " + page_results['bibliotek'] + " (" + page_results['bibnr'] + ")")).get,
+                    label_visibility="collapsed"
+                )
+                
+                st.markdown("---")
+                col1, col2 = st.columns([6, 1])
+                with col2:
+                    if st.button("✏️ Rediger", key=f"edit_{selected_bibnr}", use_container_width=True):
+                        st.session_state[f"edit_mode_{selected_bibnr}"] = True
+                
+                edit_mode = st.session_state.get(f"edit_mode_{selected_bibnr}", False)
+                show_library_details(get_library(selected_bibnr, st.session_state.db_path), edit_mode=edit_mode)
         else:
             st.info("👆 Skriv i søkefeltet for å finne bibliotek")
     
-    with tab3:
+    elif view == views[2]:
         st.markdown("## 🗺️ Kartvisning")
         
-        if FOLIUM_AVAILABLE:
-            map_obj = create_map(df_filtered)
-            if map_obj:
-                st.info(f"Viser {df_filtered['lat'].notna().sum()} av {len(df_filtered)} bibliotek")
-                st_folium(map_obj, width=1400, height=600)
-            else:
-                st.warning("Ingen bibliotek med koordinater")
+        spatial = dataset.spatial(df)
+        df_map = df_filtered
+        if len(spatial) > 0:
+            with st.expander("📐 Avgrens kartutsnitt"):
+                lat_bounds = (float(np.floor(spatial.lat.min())), float(np.ceil(spatial.lat.max())))
+                lon_bounds = (float(np.floor(spatial.lon.min())), float(np.ceil(spatial.lon.max())))
+                south, north = st.slider("Breddegrad", *lat_bounds, value=lat_bounds, step=0.1)
+                west, east = st.slider("Lengdegrad", *lon_bounds, value=lon_bounds, step=0.1)
+            if (south, north, west, east) != (*lat_bounds, *lon_bounds):
+                # df has a RangeIndex, so index labels are the mask positions
+                df_map = df_filtered[spatial.bbox(south, west, north, east)[df_filtered.index]]
+        
+        points = map_points(df_map)
+        if len(points) == 0:
+            st.warning("Ingen bibliotek med koordinater")
         else:
-            st.warning("⚠️ Installer folium: pip install folium streamlit-folium")
+            st.info(f"Viser {len(points)} av {len(df_filtered)} bibliotek")
+            if FOLIUM_AVAILABLE:
+                st_folium = load_module('streamlit_folium').st_folium
+                st_folium(cached_map(points), width=1400, height=600, returned_objects=[])
+            else:
+                st.caption("Installer folium for klyngekart: pip install folium streamlit-folium")
+                st.pydeck_chart(create_deck(points), height=600)
+        
+        if len(points) > 0:
+            st.markdown("### 📍 Nærmeste bibliotek")
+            col1, col2, col3 = st.columns([3, 1, 1])
+            with col1:
+                origin = st.selectbox(
+                    "Bibliotek",
+                    options=df_map.index[df_map['lat'].notna() & df_map['lon'].notna()],
+                    format_func=lambda pos: f"{df.at[pos, 'bibliotek']} ({df.at[pos, 'bibnr']})"
+                )
+            with col2:
+                nearby_mode = st.radio("Vis", ["Nærmeste", "Innenfor avstand"], key="nearby_mode")
+            with col3:
+                if nearby_mode == "Nærmeste":
+                    k = st.number_input("Antall", min_value=1, max_value=100, value=5)
+                    max_km = st.number_input("Maks avstand (km)", min_value=0.0, value=0.0, step=10.0,
+                                             help="0 betyr ingen grense")
+                else:
+                    radius_km = st.number_input("Avstand (km)", min_value=0.1, value=10.0, step=5.0)
+            
+            if nearby_mode == "Nærmeste":
+                positions, distances = spatial.nearest_to(origin, k=int(k))
+                if max_km > 0:
+                    positions, distances = positions[distances <= max_km], distances[distances <= max_km]
+            else:
+                positions, distances = spatial.within_to(origin, radius_km)
+                st.caption(f"{len(positions)} bibliotek innenfor {radius_km:g} km")
+            if len(positions) > 0:
+                st.dataframe(spatial.nearest_frame(positions, distances), use_container_width=True, hide_index=True)
+            else:
+                st.info("Ingen andre bibliotek innenfor avstanden")
     
-    with tab4:
-        st.markdown("## 🔄 Hent data fra API")
-        st.info("Her kan du hente nye data fra BaseBibliotek API. Du trenger en CSV-fil med biblioteknumre.")
+    elif view == views[3]:
+        st.markdown("## 🕓 Historikk")
         
-        csv_file = st.file_uploader("Last opp CSV", type=['csv'], key="csv_uploader")
+        st.markdown("### 🔁 Systemskifter")
+        col1, col2 = st.columns(2)
+        with col1:
+            year = st.number_input("År", min_value=2000, max_value=datetime.now().year, value=datetime.now().year)
+        with col2:
+            target_system = st.selectbox("Til system", options=[None] + filters.options['biblioteksystem'],
+                                         format_func=lambda system: system or "Alle")
         
-        if csv_file:
-            try:
-                df_bibnr = pd.read_csv(csv_file, header=None, names=['bibnr'])
-                bibnr_list = df_bibnr['bibnr'].astype(str).tolist()
-                st.success(f"Fant {len(bibnr_list)} biblioteknumre")
-                
-                if st.button("🚀 Start datahenting", type="primary"):
-                    # API fetching code here (same as before)
-                    st.info("Datahenting implementert - kjører...")
-            except Exception as e:
-                st.error(f"Feil: {str(e)}")
+        changes = system_changes(f"{year}-01-01", f"{year + 1}-01-01", target_system, st.session_state.db_path)
+        if len(changes) > 0:
+            changes = changes.merge(df[['bibnr', 'bibliotek']], on='bibnr', how='left')
+            changes = changes[['changed_at', 'bibnr', 'bibliotek', 'prev_katsyst', 'katsyst']]
+            changes.columns = ['Tidspunkt', 'Bibnr', 'Bibliotek', 'Fra system', 'Til system']
+            st.info(f"{changes['Bibnr'].nunique()} bibliotek skiftet system i {year}")
+            st.dataframe(changes, use_container_width=True, hide_index=True)
+        else:
+            st.info(f"Ingen systemskifter registrert i {year}")
+        
+        st.markdown("---")
+        st.markdown("### 📅 Tilstand per dato")
+        as_of_date = st.date_input("Dato", value=datetime.now().date(), max_value=datetime.now().date())
+        df_then = dataset_as_of(f"{as_of_date.isoformat()}T23:59:59", dataset.version, st.session_state.db_path)
+        if df_then is not None:
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                st.metric("Bibliotek", len(df_then), delta=len(df_then) - len(df), delta_color="off",
+                          help="Endring er i forhold til i dag")
+            with col2:
+                st.metric("Bibliotektyper", df_then['bibliotektype'].nunique())
+            with col3:
+                st.metric("Biblioteksystemer", df_then['biblioteksystem'].nunique())
+            st.bar_chart(df_then['biblioteksystem'].value_counts().loc[lambda counts: counts > 0])
+            display_then = df_then[['bibnr', 'bibliotek', 'biblioteksystem', 'bibliotektype', 'kommune_navn', 'poststed']]
+            st.dataframe(display_then.set_axis(['Bibnr', 'Bibliotek', 'System', 'Type', 'Kommune', 'Poststed'], axis=1),
+                         use_container_width=True, hide_index=True)
+        else:
+            st.info("Ingen bibliotek var registrert på denne datoen")
+    
+    elif view == views[4]:
+        show_api_fetch()
+    
+    if stage_timings().enabled:
+        stage_timings().record(f"view: {view}", time.perf_counter() - view_started)
+
+elif data_source == "Hent fra API":
+    show_api_fetch()
 
 else:
     st.markdown("## Velkommen til Bibliotekdata! 👋")
@@ -605,5 +756,52 @@ else:
     - 🔍 **Søk** - Finn spesifikke bibliotek raskt
     - 🗺️ **Kart** - Geografisk visning
     - 📊 **Statistikk** - Oversikt og analyse
-    - 💾 **Eksport** - Last ned til Excel
-    """)
\ No newline at end of file
+    - 💾 **Eksport** - Last ned til Excel, CSV eller Parquet
+    """)
+
+# Timing report; the current run is recorded before it is shown
+run_timings().record_run(time.perf_counter() - SCRIPT_STARTED)
+with st.sidebar:
+    with st.expander("⏱️ Ytelse"):
+        timings = run_timings().summary()
+        st.caption(f"Første kjøring i prosessen: {timings['first_run'] * 1000:.0f} ms")
+        if timings['reruns']:
+            st.caption(f"Siste omkjøring: {timings['last'] * 1000:.0f} ms")
+            st.caption(f"Median / p95 av {timings['reruns']} omkjøringer: "
+                       f"{timings['median'] * 1000:.0f} / {timings['p95'] * 1000:.0f} ms")
+        for name, seconds in run_timings().imports.items():
+            st.caption(f"Import av {name} ved første bruk: {seconds * 1000:.0f} ms")
+        queries = db.get_pool(st.session_state.db_path).stats.summary()
+        if queries:
+            st.caption("Databasekall")
+            st.dataframe(pd.DataFrame(queries).rename(columns={
+                'operation': 'Operasjon', 'calls': 'Kall', 'total_ms': 'Totalt (ms)',
+                'mean_ms': 'Snitt (ms)', 'max_ms': 'Maks (ms)'
+            }), hide_index=True, use_container_width=True)
+        
+        # Debug section: per-stage timings and metrics export, process-wide
+        stages = stage_timings()
+        if stages.enabled or st.query_params.get('debug') == '1':
+            st.caption("Steg")
+            if st.button("Slå av stegmåling" if stages.enabled else "Slå på stegmåling",
+                         key="toggle_stages", use_container_width=True):
+                stages.enabled = not stages.enabled
+                st.rerun()
+            if st.button("Stopp minnemåling" if tracemalloc.is_tracing() else "Start minnemåling (tracemalloc)",
+                         key="toggle_tracemalloc", use_container_width=True, disabled=not stages.enabled):
+                if tracemalloc.is_tracing():
+                    tracemalloc.stop()
+                else:
+                    tracemalloc.start()
+                st.rerun()
+            stage_summary = stages.summary()
+            if stage_summary:
+                st.dataframe(pd.DataFrame(stage_summary).rename(columns={
+                    'stage': 'Steg', 'calls': 'Kall', 'total_ms': 'Totalt (ms)',
+                    'mean_ms': 'Snitt (ms)', 'max_ms': 'Maks (ms)', 'peak_mb': 'Minnetopp (MB)'
+                }), hide_index=True, use_container_width=True)
+            col1, col2 = st.columns(2)
+            col1.download_button("📥 JSON", json.dumps(metrics(), indent=2), "metrics.json", "application/json",
+                                 on_click='ignore', use_container_width=True)
+            col2.download_button("📥 Prometheus", prometheus_metrics(), "metrics.prom", "text/plain",
+                                 on_click='ignore', use_container_width=True)
\ No newline at end of file
@@ -0,0 +1,383 @@
+"""Benchmarks for the data paths in core.py
+
+Run with e.g. `python benchmark.py save --sizes 2000 20000 200000`, or time
+every path with `python benchmark.py suite --output results.json` and later
+compare with `python benchmark.py suite --baseline results.json`.
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import core
+
+# (kommnr, navn, postnr, lat, lon) of the kommuner synthetic libraries are spread over
+KOMMUNER = [
+    ('0301', 'Oslo', '0150', 59.91, 10.75),
+    ('4601', 'Bergen', '5003', 60.39, 5.32),
+    ('5001', 'Trondheim', '7011', 63.43, 10.39),
+    ('1103', 'Stavanger', '4006', 58.97, 5.73),
+    ('5501', 'Tromsø', '9008', 69.65, 18.96),
+    ('4204', 'Kristiansand', '4611', 58.15, 7.99),
+    ('1508', 'Ålesund', '6002', 62.47, 6.15),
+    ('1804', 'Bodø', '8006', 67.28, 14.40),
+    ('3403', 'Hamar', '2317', 60.79, 11.07),
+    ('3101', 'Halden', '1771', 59.12, 11.39)
+]
+LIBRARY_TYPES = {'FBI': 'folkebibliotek', 'HØY': 'høgskolebibliotek', 'SKO': 'skolebibliotek', 'SPE': 'spesialbibliotek'}
+LIBRARY_SYSTEMS = ['Alma', 'Quria', 'Mikromarc', 'Tidemann', 'Bibliofil', None]
+
+def make_libraries(n, seed=42):
+    """Generate n synthetic library records in the BaseBibliotek format
+
+    Covers the fields of the README's data format, including the list
+    fields; about one in ten records has no coordinates.
+    """
+    rng = random.Random(seed)
+    for i in range(n):
+        kommnr, navn, postnr, lat, lon = rng.choice(KOMMUNER)
+        bibltype = rng.choice(list(LIBRARY_TYPES))
+        bibnr = str(1000000 + i)
+        inst = f'{navn} {LIBRARY_TYPES[bibltype]} {i}'
+        if rng.random() < 0.2:
+            inst += f'\nAvdeling {rng.choice(["Sentrum", "Øst", "Vest", "Nord", "Sør"])}'
+        yield {
+            'rid': i + 1,
+            'bibnr': bibnr,
+            'isil': f'NO-{bibnr}',
+            'inst': inst,
+            'katsyst': rng.choice(LIBRARY_SYSTEMS),
+            'bibltype': bibltype,
+            'kommnr': {'kommnr': kommnr, 'navn': navn},
+            'vadr': f'Storgata {rng.randint(1, 200)}',
+            'vpostnr': postnr,
+            'vpoststed': navn.upper(),
+            'tlf': f'{rng.randint(20000000, 99999999)}',
+            'epostAdr': f'bibliotek{i}@{navn.lower()}.kommune.no',
+            'urlHjem': f'https://{navn.lower()}.bibliotek.no/{i}',
+            'urlKat': f'https://{navn.lower()}.bib.no/katalog',
+            'orgnr': f'{rng.randint(800000000, 999999999)}',
+            'bibleder': f'Leder {i}',
+            'lat_lon': f'{lat + rng.gauss(0, 0.3):.5f}, {lon + rng.gauss(0, 0.3):.5f}' if rng.random() < 0.9 else None,
+            'eressurser': [{'infotype': 'Nettside', 'url': f'https://{navn.lower()}.bibliotek.no/{i}/{k}',
+                            'tekstNor': 'Nettsted', 'tekstEng': 'Website'} for k in range(rng.randint(0, 3))],
+            'altkoder': [{'kodetype': 'biblnr', 'kode': f'{kommnr}{i:06d}'}] if rng.random() < 0.5 else [],
+            'merknader': [{'mtype': 'Info', 'lang': 'no', 'tekst': rng.choice(
+                ['Åpent alle hverdager', 'Meråpent bibliotek', 'Stengt i juli', 'Selvbetjent utlån'])}
+                for _ in range(rng.randint(0, 2))]
+        }
+
+def legacy_save_to_database(data, db_path):
+    """The original save path: one execute per row in the default journal mode"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    for lib in data:
+        c.execute('''INSERT OR REPLACE INTO bibliotek (rid, bibnr, data)
+                     VALUES (?, ?, ?)''', (lib.get('rid'), lib.get('bibnr'), json.dumps(lib, ensure_ascii=False)))
+    conn.commit()
+    conn.close()
+
+def legacy_json_to_dataframe(data):
+    """The original json_to_dataframe: one dict per record, parsed in a Python loop"""
+    records = []
+    for lib in data:
+        record = {
+            'rid': lib.get('rid'),
+            'bibnr': lib.get('bibnr'),
+            'bibliotek': lib.get('inst', '').split('\n')[0] if lib.get('inst') else '',
+            'bibliotek_full': lib.get('inst'),
+            'biblioteksystem': lib.get('katsyst'),
+            'bibliotektype': lib.get('bibltype'),
+            'kommunenr': lib['kommnr'].get('kommnr') if lib.get('kommnr') else None,
+            'kommune_navn': lib['kommnr'].get('navn') if lib.get('kommnr') else None,
+            'adresse': lib.get('vadr'),
+            'postnr': lib.get('vpostnr'),
+            'poststed': lib.get('vpoststed'),
+            'epost': lib.get('epostAdr'),
+            'telefon': lib.get('tlf'),
+            'nettside': lib.get('urlHjem'),
+            'katalog': lib.get('urlKat'),
+            'lat_lon': lib.get('lat_lon'),
+            'orgnr': lib.get('orgnr'),
+            'bibleder': lib.get('bibleder'),
+            'isil': lib.get('isil'),
+            'raw_data': lib
+        }
+        
+        if record['lat_lon']:
+            try:
+                parts = record['lat_lon'].split(',')
+                record['lat'] = float(parts[0].strip())
+                record['lon'] = float(parts[1].strip())
+            except:
+                record['lat'] = None
+                record['lon'] = None
+        else:
+            record['lat'] = None
+            record['lon'] = None
+        
+        if record['kommunenr']:
+            try:
+                record['fylke_nr'] = record['kommunenr'][:2]
+            except:
+                record['fylke_nr'] = None
+        else:
+            record['fylke_nr'] = None
+        
+        records.append(record)
+    
+    return pd.DataFrame(records)
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - started
+
+def best_of(repeat, func, *args, **kwargs):
+    """Fastest of `repeat` timed calls"""
+    return min(timed(func, *args, **kwargs) for _ in range(repeat))
+
+def timed_with_reader(db_path, func, *args, **kwargs):
+    """Time func while another connection keeps reading; also return the longest read"""
+    stop = threading.Event()
+    waits = [0.0]
+
+    def reader():
+        conn = sqlite3.connect(db_path, timeout=60)
+        while not stop.is_set():
+            started = time.perf_counter()
+            conn.execute('SELECT COUNT(*) FROM bibliotek').fetchone()
+            waits.append(time.perf_counter() - started)
+            time.sleep(0.001)
+        conn.close()
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        elapsed = timed(func, *args, **kwargs)
+    finally:
+        stop.set()
+        thread.join()
+    return elapsed, max(waits)
+
+def bench_save(sizes):
+    """Compare the legacy row-by-row save with the batched WAL save, and re-saving unchanged data"""
+    results = []
+    for n in sizes:
+        data = list(make_libraries(n))
+        with tempfile.TemporaryDirectory() as tmp:
+            legacy_db = os.path.join(tmp, "legacy.db")
+            conn = sqlite3.connect(legacy_db)
+            conn.execute('CREATE TABLE bibliotek (rid INTEGER PRIMARY KEY, bibnr TEXT UNIQUE, data TEXT)')
+            conn.close()
+            legacy, legacy_read = timed_with_reader(legacy_db, legacy_save_to_database, data, legacy_db)
+
+            batched_db = os.path.join(tmp, "batched.db")
+            core.init_database(batched_db)
+            batched, batched_read = timed_with_reader(batched_db, core.save_to_database, data, batched_db)
+            resave = timed(core.save_to_database, data, batched_db)
+
+            streamed_db = os.path.join(tmp, "streamed.db")
+            core.init_database(streamed_db)
+            streamed = timed(core.save_to_database, make_libraries(n), streamed_db)
+
+        results.append({
+            'rows': n,
+            'legacy_s': legacy,
+            'batched_s': batched,
+            'streamed_s': streamed,
+            'resave_s': resave,
+            'legacy_max_read_s': legacy_read,
+            'batched_max_read_s': batched_read
+        })
+    return results
+
+def bench_dataframe(sizes):
+    """Compare the legacy record loop with the columnar json_to_dataframe"""
+    results = []
+    for n in sizes:
+        data = list(make_libraries(n))
+        legacy_df = legacy_json_to_dataframe(data)
+        columnar_df = core.json_to_dataframe(data)
+        results.append({
+            'rows': n,
+            'legacy_s': timed(legacy_json_to_dataframe, data),
+            'columnar_s': timed(core.json_to_dataframe, data),
+            'legacy_mb': legacy_df.memory_usage(deep=True).sum() / 1e6,
+            'columnar_mb': columnar_df.memory_usage(deep=True).sum() / 1e6
+        })
+    return results
+
+def bench_load(sizes):
+    """Compare a cold load that parses the JSON with one from the Arrow snapshot"""
+    results = []
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "bibliotek.db")
+            core.init_database(db_path)
+            core.save_to_database(make_libraries(n), db_path)
+            version = core.get_data_version(db_path)
+            # The first load writes the snapshot
+            core.SharedDataset(db_path).get()
+            # Closing the pooled connections checkpoints the WAL into the file
+            core.db.get_pool(db_path).close()
+            results.append({
+                'rows': n,
+                'json_s': timed(lambda: core.json_to_dataframe(core.load_from_database(db_path))),
+                'snapshot_s': timed(core.load_snapshot, db_path, version),
+                'db_mb': os.path.getsize(db_path) / 1e6,
+                'snapshot_mb': os.path.getsize(core.snapshot_path(db_path)) / 1e6
+            })
+    return results
+
+# (fylke_nr, bibliotektyper, biblioteksystemer) selections for the filter step
+SUITE_FILTERS = [
+    (None, (), ()),
+    ('03', (), ()),
+    (None, ('FBI',), ('Alma', 'Quria')),
+    ('46', ('SKO', 'HØY'), ('Mikromarc',))
+]
+SUITE_QUERIES = ['oslo', 'bergen folkebibliotek', 'tromso', '1000123', 'storgata 12', 'meråpent']
+
+def bench_suite(sizes, repeat=3):
+    """Time each core path on synthetic data; one row per size and step
+
+    Fast read-only steps are the best of `repeat` runs; the save and the
+    exports run once. Filter and search times are per query.
+    """
+    # Imported up front so the first export or map doesn't pay for it
+    for name in ['openpyxl', 'pyarrow.parquet', 'folium', 'folium.plugins', 'pydeck']:
+        if importlib.util.find_spec(name.split('.')[0]):
+            core.load_module(name)
+    
+    results = []
+    for n in sizes:
+        steps = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, "bibliotek.db")
+            core.init_database(db_path)
+            steps['save_to_database'] = timed(core.save_to_database, make_libraries(n), db_path)
+            version = core.get_data_version(db_path)
+            
+            steps['load_from_database'] = best_of(repeat, core.load_from_database, db_path)
+            data = core.load_from_database(db_path)
+            steps['json_to_dataframe'] = best_of(repeat, core.json_to_dataframe, data)
+            df = core.json_to_dataframe(data)
+            del data
+            steps['write_snapshot'] = best_of(repeat, core.write_snapshot, df, version, db_path)
+            steps['load_snapshot'] = best_of(repeat, core.load_snapshot, db_path, version)
+            
+            # Without its LRU cache, so every selection is computed
+            steps['filter_index'] = best_of(repeat, core.FilterEngine, df)
+            engine = core.FilterEngine(df, cache_size=0)
+            steps['filter_query'] = best_of(repeat, lambda: [df[engine.mask(*selection)] for selection in SUITE_FILTERS]) / len(SUITE_FILTERS)
+            
+            if core.FTS5_AVAILABLE:
+                steps['search_fts'] = best_of(repeat, lambda: [core.rank_search_hits(df, core.search_libraries(query, db_path))
+                                                               for query in SUITE_QUERIES]) / len(SUITE_QUERIES)
+            steps['search_substring'] = best_of(repeat, lambda: [core.rank_substring_hits(df, query)
+                                                                 for query in SUITE_QUERIES]) / len(SUITE_QUERIES)
+            
+            # Built and rendered to the HTML/JSON the browser receives
+            points = core.map_points(df)
+            if importlib.util.find_spec('folium'):
+                steps['create_map'] = best_of(repeat, lambda: core.create_map(points).get_root().render())
+            if importlib.util.find_spec('pydeck'):
+                steps['create_deck'] = best_of(repeat, lambda: core.create_deck(points).to_json())
+            
+            for export_format, (writer, extension, _, supports_full) in core.EXPORT_FORMATS.items():
+                steps[f'export_{extension}'] = timed(writer, df, BytesIO())
+                if supports_full:
+                    steps[f'export_{extension}_full'] = timed(writer, df, BytesIO(), db_path)
+            core.db.get_pool(db_path).close()
+        
+        results.extend({'rows': n, 'step': step, 'seconds': seconds} for step, seconds in steps.items())
+    return results
+
+BENCHMARKS = {
+    'save': bench_save,
+    'dataframe': bench_dataframe,
+    'load': bench_load,
+    'suite': bench_suite
+}
+DEFAULT_SIZES = {'suite': [2000, 50000, 500000]}
+
+def environment():
+    """Versions and machine details stored with JSON results"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'sqlite': sqlite3.sqlite_version,
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'pyarrow': pa.__version__
+    }
+
+def compare(results, baseline):
+    """Add the baseline value and current/baseline ratio of every float column"""
+    def key(row):
+        return tuple((col, value) for col, value in row.items() if not isinstance(value, float))
+    
+    previous = {key(row): row for row in baseline['results']}
+    compared = []
+    for row in results:
+        old = previous.get(key(row), {})
+        row = dict(row)
+        for col, value in list(row.items()):
+            if isinstance(value, float):
+                row[f'baseline_{col}'] = old.get(col)
+                row[f'ratio_{col}'] = value / old[col] if old.get(col) else None
+        compared.append(row)
+    return compared
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--sizes', type=int, nargs='+')
+    parser.add_argument('--repeat', type=int, default=3, help="runs per step in the suite (the fastest counts)")
+    parser.add_argument('--output', help="write the results as JSON to this file")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare with")
+    args = parser.parse_args()
+    
+    sizes = args.sizes or DEFAULT_SIZES.get(args.benchmark, [2000, 20000, 200000])
+    if args.benchmark == 'suite':
+        results = bench_suite(sizes, args.repeat)
+    else:
+        results = BENCHMARKS[args.benchmark](sizes)
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'benchmark': args.benchmark, 'created': datetime.now().isoformat(timespec='seconds'),
+                       'seed': 42, 'sizes': sizes, 'environment': environment(), 'results': results}, f, indent=2)
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            results = compare(results, json.load(f))
+    
+    columns = list(dict.fromkeys(col for row in results for col in row))
+    print("  ".join(f"{col:>18}" for col in columns))
+    for row in results:
+        print("  ".join(f"{row.get(col):>18.4f}" if isinstance(row.get(col), float) else f"{str(row.get(col)):>18}" for col in columns))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""Bulk import, API sync and export from the command line, without Streamlit
+
+Run e.g. from cron:
+
+    python cli.py import bib_data.json
+    python cli.py sync biblioteknumre.csv --remove-missing
+    python cli.py export bibliotek.xlsx bibliotek.parquet --fylke 03
+
+Files given to import and export are handled in parallel worker processes,
+so heavy jobs run outside the Streamlit server. The exit status is non-zero
+if any file or request failed.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+import core
+
+# File extension: export format name
+EXPORT_EXTENSIONS = {extension: name for name, (_, extension, _, _) in core.EXPORT_FORMATS.items()}
+
+def import_file(path, db_path):
+    """Ingest one JSON file and return its report"""
+    with open(path, 'rb') as fileobj:
+        return core.ingest_json(fileobj, db_path, os.path.basename(path))
+
+def export_file(output, export_format, db_path, full_records=False, fylke_nr=None, bibliotektyper=(), biblioteksystemer=()):
+    """Write the (filtered) libraries to `output` and return the number of rows"""
+    df = core.SharedDataset(db_path).get()
+    if df is None:
+        raise ValueError("Databasen er tom")
+    df = df[core.FilterEngine(df).mask(fylke_nr, bibliotektyper, biblioteksystemer)]
+    writer, _, _, supports_full = core.EXPORT_FORMATS[export_format]
+    with open(output, 'wb') as fileobj:
+        writer(df, fileobj, db_path if full_records and supports_full else None)
+    return len(df)
+
+def run_in_processes(func, jobs, workers):
+    """Call func(*args) for every (name, args) job in a process pool; yield (name, result, error)"""
+    # Spawned rather than forked, so workers don't inherit pooled SQLite connections
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [(name, executor.submit(func, *args)) for name, args in jobs]
+        for name, future in futures:
+            try:
+                yield name, future.result(), None
+            except Exception as e:
+                yield name, None, e
+
+def command_import(args):
+    failed = False
+    jobs = [(path, (path, args.db)) for path in args.files]
+    for path, report, error in run_in_processes(import_file, jobs, args.workers):
+        if error:
+            print(f"{path}: feil: {error}", file=sys.stderr)
+            failed = True
+        elif report['previous']:
+            print(f"{path}: allerede importert {report['previous']['imported_at']} ({report['previous']['saved']} bibliotek)")
+        else:
+            print(f"{path}: {report['saved']} lagret, {report['skipped']} hoppet over")
+            for message in report['errors']:
+                print(f"  {message}", file=sys.stderr)
+    return 1 if failed else 0
+
+def command_sync(args):
+    if args.bibnr_file:
+        bibnr_list = pd.read_csv(args.bibnr_file, header=None, names=['bibnr'])['bibnr'].astype(str).tolist()
+    else:
+        bibnr_list = list(core.load_sync_state(args.db))
+    if not bibnr_list:
+        print("Ingen biblioteknumre å hente", file=sys.stderr)
+        return 1
+
+    started = time.perf_counter()
+    fetched = core.fetch_libraries(
+        bibnr_list,
+        max_workers=args.max_workers,
+        rate_limit=args.rate_limit,
+        sync_state=None if args.full else core.load_sync_state(args.db)
+    )
+    report = core.sync_to_database(fetched, bibnr_list, args.db, remove_missing=args.remove_missing)
+    print(f"Synk fullført på {time.perf_counter() - started:.1f} s: "
+          f"{len(report['added'])} nye, {len(report['changed'])} endrede, {len(report['unchanged'])} uendrede, "
+          f"{len(report['removed'])} {'slettet' if args.remove_missing else 'mangler i listen'}")
+    for bibnr, error in fetched['errors'].items():
+        print(f"{bibnr}: {error}", file=sys.stderr)
+    return 1 if fetched['errors'] else 0
+
+def command_export(args):
+    jobs = []
+    for output in args.outputs:
+        export_format = args.format or EXPORT_EXTENSIONS.get(os.path.splitext(output)[1].lstrip('.').lower())
+        if export_format is None:
+            print(f"{output}: ukjent filtype, bruk --format", file=sys.stderr)
+            return 1
+        jobs.append((output, (output, export_format, args.db, args.full_records, args.fylke, args.type, args.system)))
+
+    failed = False
+    for output, rows, error in run_in_processes(export_file, jobs, args.workers):
+        if error:
+            print(f"{output}: feil: {error}", file=sys.stderr)
+            failed = True
+        else:
+            print(f"{output}: {rows} bibliotek")
+    return 1 if failed else 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default="bibliotek.db", help="SQLite-database (standard: bibliotek.db)")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    import_parser = commands.add_parser('import', help="importer JSON-filer fra BaseBibliotek")
+    import_parser.add_argument('files', nargs='+')
+    import_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    import_parser.set_defaults(run=command_import)
+
+    sync_parser = commands.add_parser('sync', help="hent bibliotek fra API-et og skriv nye og endrede")
+    sync_parser.add_argument('bibnr_file', nargs='?', help="CSV med biblioteknumre (standard: alle i databasen)")
+    sync_parser.add_argument('--full', action='store_true', help="hent alle poster på nytt uten betingede forespørsler")
+    sync_parser.add_argument('--remove-missing', action='store_true', help="slett bibliotek som ikke er i listen")
+    sync_parser.add_argument('--max-workers', type=int, default=core.API_MAX_WORKERS)
+    sync_parser.add_argument('--rate-limit', type=float, default=core.API_RATE_LIMIT, help="maks forespørsler per sekund, 0 = ubegrenset")
+    sync_parser.set_defaults(run=command_sync)
+
+    export_parser = commands.add_parser('export', help="eksporter bibliotek til Excel, CSV eller Parquet")
+    export_parser.add_argument('outputs', nargs='+', help="filer å skrive; formatet følger filendelsen")
+    export_parser.add_argument('--format', choices=list(core.EXPORT_FORMATS))
+    export_parser.add_argument('--full-records', action='store_true', help="ta med ressurser, koder og merknader (Excel)")
+    export_parser.add_argument('--fylke', help="fylkesnummer, f.eks. 03")
+    export_parser.add_argument('--type', nargs='+', default=(), help="bibliotektyper")
+    export_parser.add_argument('--system', nargs='+', default=(), help="biblioteksystemer")
+    export_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    export_parser.set_defaults(run=command_export)
+
+    args = parser.parse_args()
+    core.init_database(args.db)
+    sys.exit(args.run(args))
+
+if __name__ == "__main__":
+    main()
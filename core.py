@@ -0,0 +1,1909 @@
+"""Data layer of the library app: storage, import, API fetch, frames and export
+
+Has no Streamlit dependency, so app.py, cli.py and benchmark.py share it.
+"""
+import time
+import json
+import contextlib
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import TextIOWrapper
+from datetime import datetime, timedelta
+import sqlite3
+import hashlib
+import codecs
+import functools
+import itertools
+import re
+import threading
+import collections
+import importlib
+import sys
+import os
+
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import db
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Check if SQLite was built with FTS5
+try:
+    sqlite3.connect(':memory:').execute('CREATE VIRTUAL TABLE fts5_check USING fts5(x)')
+    FTS5_AVAILABLE = True
+except sqlite3.OperationalError:
+    FTS5_AVAILABLE = False
+
+# Instrumentation
+class RunTimings:
+    """Script run and lazy import durations for this process, for the timing report"""
+
+    def __init__(self, history=200):
+        self.lock = threading.Lock()
+        self.first_run = None
+        self.runs = collections.deque(maxlen=history)
+        self.rerun_count = 0
+        self.imports = {}
+
+    def record_run(self, seconds):
+        with self.lock:
+            if self.first_run is None:
+                self.first_run = seconds
+            else:
+                self.runs.append(seconds)
+                self.rerun_count += 1
+
+    def record_import(self, name, seconds):
+        with self.lock:
+            self.imports[name] = seconds
+
+    def summary(self):
+        """First run (cold start) and recent rerun statistics, in seconds"""
+        with self.lock:
+            runs = list(self.runs)
+            rerun_count = self.rerun_count
+        return {
+            'first_run': self.first_run,
+            'reruns_total': rerun_count,
+            'reruns': len(runs),
+            'last': runs[-1] if runs else None,
+            'median': float(np.median(runs)) if runs else None,
+            'p95': float(np.percentile(runs, 95)) if runs else None
+        }
+
+RUN_TIMINGS = RunTimings()
+
+def run_timings():
+    return RUN_TIMINGS
+
+def load_module(name):
+    """Import a feature's heavy dependency on first use and record how long it took"""
+    if name not in sys.modules:
+        started = time.perf_counter()
+        importlib.import_module(name)
+        run_timings().record_import(name, time.perf_counter() - started)
+    return sys.modules[name]
+
+class StageTimings:
+    """Call counts, durations and memory peaks of the instrumented stages in this process
+
+    Off unless enabled; a disabled stage costs one attribute check. Memory
+    peaks are only measured while tracemalloc is tracing and include
+    allocations by other threads running at the same time.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        
+        # tracemalloc has a single peak counter, so a nested stage hands the
+        # peak it resets over to the stage around it
+        frame = None
+        if tracemalloc.is_tracing():
+            stack = self.local.__dict__.setdefault('stack', [])
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            frame = [current, 0]
+            stack.append(frame)
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            peak_bytes = None
+            if frame is not None:
+                stack.remove(frame)
+                if tracemalloc.is_tracing():
+                    peak = max(tracemalloc.get_traced_memory()[1], frame[1])
+                    peak_bytes = peak - frame[0]
+                    if stack:
+                        stack[-1][1] = max(stack[-1][1], peak)
+            self.record(name, seconds, peak_bytes)
+
+    def record(self, name, seconds, peak_bytes=None):
+        with self.lock:
+            calls, total, longest, peak = self.stats.get(name, (0, 0.0, 0.0, None))
+            if peak_bytes is not None:
+                peak = max(peak or 0, peak_bytes)
+            self.stats[name] = (calls + 1, total + seconds, max(longest, seconds), peak)
+
+    def summary(self):
+        """One row per stage, slowest total first, in milliseconds and MB"""
+        with self.lock:
+            stats = dict(self.stats)
+        return sorted(({'stage': name, 'calls': calls, 'total_ms': total * 1000, 'mean_ms': total / calls * 1000,
+                        'max_ms': longest * 1000, 'peak_mb': peak / 1e6 if peak is not None else None}
+                       for name, (calls, total, longest, peak) in stats.items()),
+                      key=lambda row: row['total_ms'], reverse=True)
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+STAGE_TIMINGS = StageTimings(enabled=os.environ.get('BIBLIOTEK_INSTRUMENTATION') == '1')
+
+def stage_timings():
+    return STAGE_TIMINGS
+
+def timed_stage(name=None):
+    """Decorator that records each call of a function as a stage (by default its name)"""
+    def decorator(func):
+        stage = name or func.__name__
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not STAGE_TIMINGS.enabled:
+                return func(*args, **kwargs)
+            with STAGE_TIMINGS.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def max_rss_bytes():
+    """Peak resident memory of this process, or None where it can't be read"""
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def metrics():
+    """Script runs, lazy imports, stages and database operations of this process"""
+    return {
+        'runs': run_timings().summary(),
+        'imports': dict(run_timings().imports),
+        'stages': stage_timings().summary(),
+        'database': {pool.db_path: pool.stats.summary() for pool in list(db.POOLS.values())},
+        'max_rss_bytes': max_rss_bytes()
+    }
+
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_metrics():
+    """metrics() in the Prometheus text exposition format"""
+    data = metrics()
+    lines = []
+    
+    def metric(name, kind, description, samples):
+        samples = [(labels, value) for labels, value in samples if value is not None]
+        if not samples:
+            return
+        lines.append(f"# HELP bibliotek_{name} {description}")
+        lines.append(f"# TYPE bibliotek_{name} {kind}")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{prometheus_label(label)}"' for key, label in labels.items())
+            lines.append(f"bibliotek_{name}{{{label_text}}} {value}" if labels else f"bibliotek_{name} {value}")
+    
+    runs = data['runs']
+    metric('script_first_run_seconds', 'gauge', "Duration of the first script run in the process",
+           [({}, runs['first_run'])])
+    metric('script_reruns_total', 'counter', "Script reruns since the process started", [({}, runs['reruns_total'])])
+    metric('script_rerun_seconds', 'gauge', "Recent script rerun durations",
+           [({'quantile': '0.5'}, runs['median']), ({'quantile': '0.95'}, runs['p95'])])
+    metric('module_import_seconds', 'gauge', "Time to import a lazily loaded module",
+           [({'module': module}, seconds) for module, seconds in data['imports'].items()])
+    for field, name, kind, scale, description in [
+        ('calls', 'stage_calls_total', 'counter', 1, "Calls of an instrumented stage"),
+        ('total_ms', 'stage_seconds_total', 'counter', 1e-3, "Time spent in an instrumented stage"),
+        ('max_ms', 'stage_max_seconds', 'gauge', 1e-3, "Longest call of an instrumented stage"),
+        ('peak_mb', 'stage_peak_bytes', 'gauge', 1e6, "Largest traced memory peak of an instrumented stage")
+    ]:
+        metric(name, kind, description,
+               [({'stage': row['stage']}, row[field] * scale if row[field] is not None else None) for row in data['stages']])
+    for field, name, kind, scale, description in [
+        ('calls', 'db_calls_total', 'counter', 1, "Database operations"),
+        ('total_ms', 'db_seconds_total', 'counter', 1e-3, "Time spent in database operations"),
+        ('max_ms', 'db_max_seconds', 'gauge', 1e-3, "Longest database operation")
+    ]:
+        metric(name, kind, description,
+               [({'database': path, 'operation': row['operation']}, row[field] * scale)
+                for path, rows in data['database'].items() for row in rows])
+    metric('max_rss_bytes', 'gauge', "Peak resident memory of the process", [({}, data['max_rss_bytes'])])
+    return '\n'.join(lines) + '\n'
+
+# Database functions
+SAVE_BATCH_SIZE = 5000
+
+SCHEMA_VERSION = 2
+
+# Every Nth version of a library in the history table is a full copy; the
+# versions in between are diffs against the previous version
+HISTORY_CHECKPOINT_INTERVAL = 10
+
+# Columns added to the original (rid, bibnr, data) table. The sync columns
+# track API state; the rest are typed copies of fields in `data` so that
+# filters and counts can run as indexed SQL instead of parsing every blob.
+LIBRARY_COLUMNS = {
+    'content_hash': 'TEXT',
+    'etag': 'TEXT',
+    'last_modified': 'TEXT',
+    'fetched_at': 'TEXT',
+    'katsyst': 'TEXT',
+    'bibltype': 'TEXT',
+    'kommnr': 'TEXT',
+    'fylke_nr': 'TEXT',
+    'vpoststed': 'TEXT',
+    'lat': 'REAL',
+    'lon': 'REAL',
+    'orgnr': 'TEXT'
+}
+LIBRARY_INDEXES = ['katsyst', 'bibltype', 'kommnr', 'fylke_nr', 'vpoststed', 'orgnr', 'lat, lon']
+
+# Child tables for the list fields of a record, keyed by (bibnr, pos)
+CHILD_TABLES = {
+    'eressurser': ['infotype', 'url', 'tekstNor', 'tekstEng'],
+    'altkoder': ['kodetype', 'kode'],
+    'merknader': ['mtype', 'lang', 'tekst']
+}
+
+# Columns written for every library, in the order returned by library_row
+WRITE_COLUMNS = ['rid', 'bibnr', 'data', 'content_hash', 'katsyst', 'bibltype',
+                 'kommnr', 'fylke_nr', 'vpoststed', 'lat', 'lon', 'orgnr']
+INSERT_LIBRARY_SQL = (f"INSERT OR REPLACE INTO bibliotek ({', '.join(WRITE_COLUMNS)}) "
+                      f"VALUES ({', '.join('?' for _ in WRITE_COLUMNS)})")
+UPDATE_LIBRARY_SQL = (f"UPDATE bibliotek SET {', '.join(f'{col} = ?' for col in WRITE_COLUMNS[2:])} "
+                      f"WHERE bibnr = ?")
+
+# Full-text index columns and their bm25 weights (higher ranks higher).
+# The FTS rowid is the rowid of the library in the bibliotek table.
+SEARCH_COLUMNS = {
+    'bibnr': 5.0,
+    'navn': 10.0,
+    'kommune': 4.0,
+    'poststed': 4.0,
+    'adresse': 1.0,
+    'isil': 5.0,
+    'merknader': 0.5
+}
+NORWEGIAN_FOLDING = str.maketrans({'æ': 'ae', 'ø': 'o', 'å': 'a'})
+
+def init_database(db_path="bibliotek.db"):
+    """Initialize SQLite database"""
+    with db.connection(db_path, 'init_database') as conn:
+        c = conn.cursor()
+        
+        # Create main table
+        columns = ''.join(f',\n                  {col} {col_type}' for col, col_type in LIBRARY_COLUMNS.items())
+        c.execute(f'''CREATE TABLE IF NOT EXISTS bibliotek
+                     (rid INTEGER PRIMARY KEY,
+                      bibnr TEXT UNIQUE,
+                      data TEXT{columns})''')
+        
+        # Add columns to databases created before they existed
+        existing = {row[1] for row in c.execute('PRAGMA table_info(bibliotek)')}
+        for column, column_type in LIBRARY_COLUMNS.items():
+            if column not in existing:
+                c.execute(f'ALTER TABLE bibliotek ADD COLUMN {column} {column_type}')
+        
+        for columns in LIBRARY_INDEXES:
+            name = columns.replace(', ', '_')
+            c.execute(f'CREATE INDEX IF NOT EXISTS idx_bibliotek_{name} ON bibliotek ({columns})')
+        
+        # Child tables
+        for table, fields in CHILD_TABLES.items():
+            field_defs = ''.join(f', {field} TEXT' for field in fields)
+            c.execute(f'''CREATE TABLE IF NOT EXISTS {table}
+                         (bibnr TEXT NOT NULL, pos INTEGER NOT NULL{field_defs},
+                          PRIMARY KEY (bibnr, pos))''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_altkoder_kode ON altkoder (kodetype, kode)')
+        
+        # Data version, bumped by every write so cached datasets know when to reload
+        c.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)')
+        c.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('data_version', 0)")
+        
+        # Imported files by content hash, so re-uploading the same file is a no-op
+        c.execute('''CREATE TABLE IF NOT EXISTS imports
+                     (file_hash TEXT PRIMARY KEY, file_name TEXT, imported_at TEXT,
+                      saved INTEGER, skipped INTEGER)''')
+        
+        # Versions of every library: kind is 'full', 'diff' or 'deleted'.
+        # katsyst and prev_katsyst make system migrations an indexed query.
+        c.execute('''CREATE TABLE IF NOT EXISTS history
+                     (bibnr TEXT NOT NULL, seq INTEGER NOT NULL, changed_at TEXT NOT NULL,
+                      kind TEXT NOT NULL, data TEXT NOT NULL, katsyst TEXT, prev_katsyst TEXT,
+                      PRIMARY KEY (bibnr, seq))''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_history_changed_at ON history (changed_at)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_history_katsyst ON history (katsyst, changed_at)')
+        
+        # Background jobs; at most one queued or running job per key
+        c.execute('''CREATE TABLE IF NOT EXISTS jobs
+                     (id INTEGER PRIMARY KEY, kind TEXT NOT NULL, job_key TEXT NOT NULL, params TEXT NOT NULL,
+                      status TEXT NOT NULL, progress REAL NOT NULL DEFAULT 0, message TEXT, result TEXT, error TEXT,
+                      cancel_requested INTEGER NOT NULL DEFAULT 0, runner TEXT, created_at TEXT NOT NULL,
+                      started_at TEXT, finished_at TEXT, updated_at TEXT NOT NULL)''')
+        c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_key ON jobs (job_key)
+                     WHERE status IN ('queued', 'running')''')
+        conn.commit()
+        
+        # Full-text index, filled from the JSON when it is first created
+        build_search_index = False
+        if FTS5_AVAILABLE:
+            build_search_index = not c.execute("SELECT 1 FROM sqlite_master WHERE name = 'bibliotek_fts'").fetchone()
+            c.execute(f'''CREATE VIRTUAL TABLE IF NOT EXISTS bibliotek_fts
+                         USING fts5({', '.join(SEARCH_COLUMNS)}, tokenize = 'unicode61 remove_diacritics 2')''')
+        if build_search_index:
+            c.execute('BEGIN IMMEDIATE')
+            insert_search_rows(conn, [json.loads(row[0]) for row in c.execute('SELECT data FROM bibliotek').fetchall()])
+            conn.commit()
+        
+        user_version = c.execute('PRAGMA user_version').fetchone()[0]
+        if user_version < SCHEMA_VERSION:
+            c.execute('BEGIN IMMEDIATE')
+            # Fill the typed columns and child tables from the JSON of older databases
+            if user_version < 1:
+                rows = c.execute('SELECT data FROM bibliotek').fetchall()
+                libs = [json.loads(row[0]) for row in rows]
+                c.executemany(UPDATE_LIBRARY_SQL, [library_row(lib)[2:] + (lib.get('bibnr'),) for lib in libs])
+                replace_child_rows(conn, libs)
+            # Start the history of existing libraries with their current state
+            if user_version < 2:
+                c.execute('''INSERT OR IGNORE INTO history (bibnr, seq, changed_at, kind, data, katsyst)
+                             SELECT bibnr, 1, COALESCE(fetched_at, ?), 'full', data, katsyst
+                             FROM bibliotek WHERE bibnr IS NOT NULL''',
+                          (datetime.now().isoformat(timespec='seconds'),))
+            c.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+    
+
+# Reusable encoder; json.dumps builds a new encoder per call when given options
+encode_json = json.JSONEncoder(ensure_ascii=False).encode
+
+def content_hash(lib, data_json=None):
+    """Hash of a library record's stored JSON, used to detect changes"""
+    if data_json is None:
+        data_json = encode_json(lib)
+    return hashlib.sha256(data_json.encode('utf-8')).hexdigest()
+
+def parse_lat_lon(lat_lon):
+    """Parse a 'lat, lon' string into floats, or (None, None) if invalid"""
+    try:
+        parts = lat_lon.split(',')
+        return float(parts[0].strip()), float(parts[1].strip())
+    except (AttributeError, IndexError, ValueError):
+        return None, None
+
+def library_row(lib):
+    """Serialize a library once into a row matching WRITE_COLUMNS"""
+    data_json = encode_json(lib)
+    kommnr = lib['kommnr'].get('kommnr') if lib.get('kommnr') else None
+    lat, lon = parse_lat_lon(lib.get('lat_lon'))
+    return (lib.get('rid'), lib.get('bibnr'), data_json, content_hash(lib, data_json),
+            lib.get('katsyst'), lib.get('bibltype'), kommnr, kommnr[:2] if kommnr else None,
+            lib.get('vpoststed'), lat, lon, lib.get('orgnr'))
+
+def replace_child_rows(conn, libs):
+    """Rewrite the eressurser, altkoder and merknader rows of the given libraries"""
+    bibnrs = [(lib.get('bibnr'),) for lib in libs]
+    for table, fields in CHILD_TABLES.items():
+        conn.executemany(f'DELETE FROM {table} WHERE bibnr = ?', bibnrs)
+        conn.executemany(
+            f"INSERT INTO {table} (bibnr, pos, {', '.join(fields)}) VALUES (?, ?{', ?' * len(fields)})",
+            [(lib.get('bibnr'), pos, *(item.get(field) for field in fields))
+             for lib in libs
+             for pos, item in enumerate(lib.get(table) or [])
+             if isinstance(item, dict)]
+        )
+
+def fold_text(text):
+    """Lowercase text and fold æ/ø/å so 'Tromso' finds 'Tromsø'"""
+    return str(text).lower().translate(NORWEGIAN_FOLDING) if text else ''
+
+def search_row(lib):
+    """Folded full-text values of a library, in SEARCH_COLUMNS order"""
+    kommune = lib['kommnr'].get('navn') if lib.get('kommnr') else None
+    merknader = ' '.join(m.get('tekst') or '' for m in lib.get('merknader') or [] if isinstance(m, dict))
+    values = (lib.get('bibnr'), lib.get('inst'), kommune, lib.get('vpoststed'),
+              lib.get('vadr'), lib.get('isil'), merknader)
+    return tuple(fold_text(value) for value in values)
+
+def delete_search_rows(conn, libs):
+    """Remove full-text rows of libraries that are about to be rewritten or deleted"""
+    if FTS5_AVAILABLE:
+        conn.executemany('''DELETE FROM bibliotek_fts WHERE rowid IN
+                            (SELECT rowid FROM bibliotek WHERE bibnr = ? OR rowid = ?)''',
+                         [(lib.get('bibnr'), lib.get('rid')) for lib in libs])
+
+def insert_search_rows(conn, libs):
+    """Add full-text rows for libraries already written to the bibliotek table"""
+    if FTS5_AVAILABLE:
+        conn.executemany(
+            f"INSERT INTO bibliotek_fts (rowid, {', '.join(SEARCH_COLUMNS)}) "
+            f"SELECT rowid{', ?' * len(SEARCH_COLUMNS)} FROM bibliotek WHERE bibnr = ?",
+            [search_row(lib) + (lib.get('bibnr'),) for lib in libs]
+        )
+
+def bump_data_version(conn):
+    """Mark the data as changed and return the new version; call inside the write transaction"""
+    conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'data_version'")
+    return conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()[0]
+
+def get_data_version(db_path="bibliotek.db"):
+    """Current data version, or None if the database isn't initialized"""
+    with db.connection(db_path, 'get_data_version') as conn:
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'data_version'").fetchone()
+        except sqlite3.OperationalError:
+            row = None
+    return row[0] if row else None
+
+def json_diff(old, new):
+    """Top-level diff between two records: changed or added keys, and removed keys"""
+    diff = {}
+    changed = {key: value for key, value in new.items() if key not in old or old[key] != value}
+    removed = [key for key in old if key not in new]
+    if changed:
+        diff['set'] = changed
+    if removed:
+        diff['unset'] = removed
+    return diff
+
+def apply_json_diff(old, diff):
+    """Record after applying a json_diff to `old`"""
+    new = {**old, **diff.get('set', {})}
+    for key in diff.get('unset', []):
+        new.pop(key, None)
+    return new
+
+def latest_history(conn, bibnrs):
+    """Latest (seq, kind) in the history of each library"""
+    # SQLite returns the bare kind column from the row holding MAX(seq)
+    rows = db.select_in(conn, 'SELECT bibnr, MAX(seq), kind FROM history WHERE bibnr IN ({}) GROUP BY bibnr', bibnrs)
+    return {bibnr: (seq, kind) for bibnr, seq, kind in rows}
+
+def stored_libraries(conn, bibnrs):
+    """Stored (data, content_hash, katsyst) of each library"""
+    rows = db.select_in(conn, 'SELECT bibnr, data, content_hash, katsyst FROM bibliotek WHERE bibnr IN ({})', bibnrs)
+    return {bibnr: rest for bibnr, *rest in rows}
+
+def record_history(conn, libs, rows, changed_at=None):
+    """Append a history version for every library whose stored JSON changes
+
+    Call inside the write transaction before the rows are written; `rows` are
+    the library_row tuples of `libs`. A library's first version, the first
+    after a deletion and every HISTORY_CHECKPOINT_INTERVAL-th version are
+    full copies; the rest are diffs against the previous version. Returns the
+    indexes of the rows that differ from what is stored.
+    """
+    changed_at = changed_at or datetime.now().isoformat(timespec='seconds')
+    bibnrs = list(dict.fromkeys(row[1] for row in rows if row[1] is not None))
+    stored = stored_libraries(conn, bibnrs)
+    latest = latest_history(conn, bibnrs)
+    
+    entries = []
+    changed = []
+    for i, (lib, row) in enumerate(zip(libs, rows)):
+        bibnr, data_json, new_hash, katsyst = row[1], row[2], row[3], row[4]
+        old = stored.get(bibnr)
+        if old and old[1] == new_hash:
+            continue
+        changed.append(i)
+        if bibnr is None:
+            continue
+        seq, kind = latest.get(bibnr, (0, None))
+        seq += 1
+        if old is None or kind in (None, 'deleted') or seq % HISTORY_CHECKPOINT_INTERVAL == 1:
+            kind, payload = 'full', data_json
+        else:
+            kind, payload = 'diff', encode_json(json_diff(json.loads(old[0]), lib))
+        entries.append((bibnr, seq, changed_at, kind, payload, katsyst, old[2] if old else None))
+        stored[bibnr] = (data_json, new_hash, katsyst)
+        latest[bibnr] = (seq, kind)
+    conn.executemany('INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?)', entries)
+    return changed
+
+def record_deletions(conn, bibnrs, changed_at=None):
+    """Append a 'deleted' version for libraries about to be deleted"""
+    changed_at = changed_at or datetime.now().isoformat(timespec='seconds')
+    stored = stored_libraries(conn, bibnrs)
+    latest = latest_history(conn, bibnrs)
+    conn.executemany('INSERT INTO history VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     [(bibnr, latest.get(bibnr, (0, None))[0] + 1, changed_at, 'deleted', '{}', None, stored[bibnr][2])
+                      for bibnr in bibnrs if bibnr in stored])
+
+def write_libraries(conn, libs):
+    """Insert or replace libraries with their typed columns, child rows, search rows and history
+
+    Libraries whose content hash matches the stored one are left alone.
+    Returns the number of written libraries; the data version is only
+    bumped if there were any.
+    """
+    rows = [library_row(lib) for lib in libs]
+    changed = record_history(conn, libs, rows)
+    if not changed:
+        return 0
+    libs = [libs[i] for i in changed]
+    rows = [rows[i] for i in changed]
+    delete_search_rows(conn, libs)
+    conn.executemany(INSERT_LIBRARY_SQL, rows)
+    replace_child_rows(conn, libs)
+    insert_search_rows(conn, libs)
+    bump_data_version(conn)
+    return len(libs)
+
+@timed_stage()
+def save_to_database(data, db_path="bibliotek.db", batch_size=SAVE_BATCH_SIZE):
+    """Save library data to database
+
+    `data` can be any iterable, including a generator, and is consumed in
+    batches of `batch_size`. Each batch is written with one executemany in
+    its own transaction, so the write lock is only held briefly and readers
+    keep working during large imports. Libraries that are stored unchanged
+    are skipped. Returns the number of saved rows, unchanged ones included.
+    The Arrow snapshot is rebuilt by the next SharedDataset load, not here,
+    so a save never has to read back the whole table.
+    """
+    data = iter(data)
+    saved = 0
+    
+    with db.connection(db_path, 'save_to_database') as conn:
+        while True:
+            batch = list(itertools.islice(data, batch_size))
+            if not batch:
+                break
+            conn.execute('BEGIN IMMEDIATE')
+            write_libraries(conn, batch)
+            conn.commit()
+            saved += len(batch)
+    
+    return saved
+
+@timed_stage()
+def load_from_database(db_path="bibliotek.db"):
+    """Load library data from database"""
+    if not os.path.exists(db_path):
+        return None
+    
+    with db.connection(db_path, 'load_from_database') as conn:
+        rows = conn.execute('SELECT data FROM bibliotek').fetchall()
+    
+    data = [json.loads(row[0]) for row in rows]
+    return data
+
+def snapshot_path(db_path="bibliotek.db"):
+    return f"{db_path}.snapshot.arrow"
+
+@timed_stage()
+def write_snapshot(df, version, db_path="bibliotek.db"):
+    """Write the flattened frame as an Arrow IPC file tagged with its data version
+
+    Returns False if the frame can't be stored as Arrow (e.g. a column with
+    mixed types) or the file can't be replaced; the app then keeps using JSON.
+    """
+    path = snapshot_path(db_path)
+    # One temp file per writer: sessions, jobs and CLI workers may write at once
+    tmp_path = f"{path}.{os.getpid()}_{threading.get_ident()}.tmp"
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({**table.schema.metadata, b'data_version': str(version).encode()})
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+    except (pa.ArrowException, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
+    return True
+
+@timed_stage()
+def load_snapshot(db_path="bibliotek.db", version=None):
+    """Memory-map the snapshot and return its frame, or None if missing or not at `version`"""
+    path = snapshot_path(db_path)
+    if version is None or not os.path.exists(path):
+        return None
+    try:
+        table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+    except (pa.ArrowException, OSError):
+        return None
+    if (table.schema.metadata or {}).get(b'data_version') != str(version).encode():
+        return None
+    
+    # Numeric and category columns come back as read-only views of the
+    # mapped file, but patch_row edits the frame in place
+    df = table.to_pandas()
+    for column in df.columns[df.dtypes != object]:
+        df[column] = df[column].copy()
+    return df
+
+def iter_child_rows(table, bibnrs, db_path="bibliotek.db"):
+    """Yield the rows of a child table for the given libraries, ordered by bibnr and pos"""
+    with db.connection(db_path, 'iter_child_rows') as conn:
+        # Pooled connections are reused, so the temp table is dropped again
+        conn.execute('CREATE TEMP TABLE IF NOT EXISTS selected_bibnr (bibnr TEXT PRIMARY KEY)')
+        try:
+            conn.executemany('INSERT OR IGNORE INTO selected_bibnr VALUES (?)', ((bibnr,) for bibnr in bibnrs))
+            yield from conn.execute(f"""SELECT {', '.join(['bibnr'] + CHILD_TABLES[table])}
+                                        FROM {table} JOIN selected_bibnr USING (bibnr)
+                                        ORDER BY bibnr, pos""")
+        finally:
+            conn.execute('DROP TABLE temp.selected_bibnr')
+
+def get_library(bibnr, db_path="bibliotek.db"):
+    """Load the full record of a single library, or None if it doesn't exist"""
+    with db.connection(db_path, 'get_library') as conn:
+        row = conn.execute('SELECT data FROM bibliotek WHERE bibnr = ?', (bibnr,)).fetchone()
+    
+    return json.loads(row[0]) if row else None
+
+def get_libraries(bibnrs, db_path="bibliotek.db"):
+    """Load the full records of many libraries in batched queries, keyed by bibnr"""
+    with db.connection(db_path, 'get_libraries') as conn:
+        rows = list(db.select_in(conn, 'SELECT bibnr, data FROM bibliotek WHERE bibnr IN ({})', bibnrs))
+    
+    return {bibnr: json.loads(data) for bibnr, data in rows}
+
+def update_library_in_db(bibnr, updated_data, db_path="bibliotek.db"):
+    """Update a single library in database and return the new data version
+
+    Raises KeyError if the library doesn't exist; nothing is written then.
+    """
+    with db.connection(db_path, 'update_library_in_db') as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if not conn.execute('SELECT 1 FROM bibliotek WHERE bibnr = ?', (bibnr,)).fetchone():
+            raise KeyError(bibnr)
+        row = library_row(updated_data)
+        record_history(conn, [updated_data], [row])
+        delete_search_rows(conn, [updated_data])
+        conn.execute(UPDATE_LIBRARY_SQL, row[2:] + (bibnr,))
+        replace_child_rows(conn, [updated_data])
+        insert_search_rows(conn, [updated_data])
+        return bump_data_version(conn)
+
+def apply_history_entry(state, kind, data):
+    """Record after one history entry; None once deleted"""
+    if kind == 'full':
+        return json.loads(data)
+    if kind == 'diff':
+        return apply_json_diff(state, json.loads(data))
+    return None
+
+def fold_history(entries):
+    """Replay (kind, data) history entries starting at a full copy"""
+    state = None
+    for kind, data in entries:
+        state = apply_history_entry(state, kind, data)
+    return state
+
+def get_history(bibnr, db_path="bibliotek.db"):
+    """All versions of a library, oldest first, with the keys each version changed"""
+    with db.connection(db_path, 'get_history') as conn:
+        rows = conn.execute('SELECT seq, changed_at, kind, data FROM history WHERE bibnr = ? ORDER BY seq',
+                            (bibnr,)).fetchall()
+    
+    versions, state = [], None
+    for seq, changed_at, kind, data in rows:
+        new_state = apply_history_entry(state, kind, data)
+        diff = json_diff(state or {}, new_state or {})
+        versions.append({'seq': seq, 'changed_at': changed_at, 'kind': kind,
+                         'changed': sorted([*diff.get('set', {}), *diff.get('unset', [])]), 'data': new_state})
+        state = new_state
+    return versions
+
+@timed_stage()
+def state_as_of(changed_at, db_path="bibliotek.db"):
+    """Every library as it was at a point in time (ISO timestamp), from the history
+
+    Each library is rebuilt from its nearest full checkpoint, so at most
+    HISTORY_CHECKPOINT_INTERVAL versions are read per library.
+    """
+    libs = []
+    with db.connection(db_path, 'state_as_of') as conn:
+        rows = conn.execute('''WITH target AS (SELECT bibnr, MAX(seq) AS seq FROM history
+                                              WHERE changed_at <= ? GROUP BY bibnr)
+                                SELECT h.bibnr, h.kind, h.data FROM history h JOIN target t USING (bibnr)
+                                WHERE h.seq BETWEEN (t.seq - 1) / ? * ? + 1 AND t.seq
+                                ORDER BY h.bibnr, h.seq''',
+                             (changed_at, HISTORY_CHECKPOINT_INTERVAL, HISTORY_CHECKPOINT_INTERVAL))
+        for _, entries in itertools.groupby(rows, key=lambda row: row[0]):
+            lib = fold_history((kind, data) for _, kind, data in entries)
+            if lib is not None:
+                libs.append(lib)
+    return libs
+
+def system_changes(start, end, katsyst=None, db_path="bibliotek.db"):
+    """Libraries that changed library system between two ISO timestamps, optionally to `katsyst`"""
+    clauses, params = ['changed_at >= ?', 'changed_at < ?'], [start, end]
+    if katsyst:
+        clauses.append('katsyst = ?')
+        params.append(katsyst)
+    
+    with db.connection(db_path, 'system_changes') as conn:
+        rows = conn.execute(f'''SELECT bibnr, changed_at, prev_katsyst, katsyst FROM history
+                                 WHERE {' AND '.join(clauses)}
+                                   AND seq > 1 AND kind != 'deleted' AND katsyst IS NOT prev_katsyst
+                                 ORDER BY changed_at''', params).fetchall()
+    return pd.DataFrame(rows, columns=['bibnr', 'changed_at', 'prev_katsyst', 'katsyst'])
+
+@timed_stage()
+def search_libraries(query, db_path="bibliotek.db", limit=None):
+    """Full-text search with prefix matching; returns bibnr values, best match first"""
+    terms = re.findall(r'\w+', fold_text(query))
+    if not terms:
+        return []
+    match = ' '.join(f'"{term}"*' for term in terms)
+    weights = ', '.join(str(weight) for weight in SEARCH_COLUMNS.values())
+    
+    with db.connection(db_path, 'search_libraries') as conn:
+        rows = conn.execute(f'''SELECT b.bibnr FROM bibliotek_fts JOIN bibliotek b ON b.rowid = bibliotek_fts.rowid
+                                WHERE bibliotek_fts MATCH ?
+                                ORDER BY bm25(bibliotek_fts, {weights}) LIMIT ?''',
+                             (match, -1 if limit is None else limit)).fetchall()
+    
+    return [row[0] for row in rows]
+
+def load_sync_state(db_path="bibliotek.db"):
+    """Load content hash and HTTP validators per bibnr"""
+    with db.connection(db_path, 'load_sync_state') as conn:
+        rows = conn.execute('SELECT bibnr, content_hash, etag, last_modified FROM bibliotek').fetchall()
+    
+    return {bibnr: {'content_hash': h, 'etag': etag, 'last_modified': modified}
+            for bibnr, h, etag, modified in rows}
+
+@timed_stage()
+def sync_to_database(fetched, bibnr_list, db_path="bibliotek.db", remove_missing=False):
+    """Write only new and changed libraries from a fetch, and report the delta
+
+    `fetched` is the result of `fetch_libraries`. Unchanged libraries (same
+    content hash, or HTTP 304) only get their fetch timestamp and validators
+    refreshed. Libraries in the database but not in `bibnr_list` are reported
+    as removed, and deleted when `remove_missing` is set.
+    """
+    state = load_sync_state(db_path)
+    fetched_at = datetime.now().isoformat(timespec='seconds')
+    
+    report = {'added': [], 'changed': [], 'unchanged': list(fetched['not_modified']), 'removed': []}
+    writes = []
+    for lib in fetched['records']:
+        bibnr = lib.get('bibnr')
+        if bibnr not in state:
+            report['added'].append(bibnr)
+        elif state[bibnr]['content_hash'] != content_hash(lib):
+            report['changed'].append(bibnr)
+        else:
+            report['unchanged'].append(bibnr)
+            continue
+        writes.append(lib)
+    
+    touches = [(*validators, fetched_at, bibnr) for bibnr, validators in fetched['validators'].items()]
+    
+    requested = set(str(bibnr) for bibnr in bibnr_list)
+    report['removed'] = sorted(bibnr for bibnr in state if bibnr not in requested)
+    
+    with db.connection(db_path, 'sync_to_database') as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        if writes:
+            write_libraries(conn, writes)
+        conn.executemany('''UPDATE bibliotek
+                            SET etag = COALESCE(?, etag), last_modified = COALESCE(?, last_modified), fetched_at = ?
+                            WHERE bibnr = ?''', touches)
+        if remove_missing and report['removed']:
+            removed = [(bibnr,) for bibnr in report['removed']]
+            record_deletions(conn, report['removed'])
+            delete_search_rows(conn, [{'bibnr': bibnr} for bibnr in report['removed']])
+            for table in ['bibliotek', *CHILD_TABLES]:
+                conn.executemany(f'DELETE FROM {table} WHERE bibnr = ?', removed)
+            bump_data_version(conn)
+    
+    return report
+
+def get_import(file_hash, db_path="bibliotek.db"):
+    """The earlier import of a file with this content hash, or None"""
+    with db.connection(db_path, 'get_import') as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        row = c.execute('SELECT * FROM imports WHERE file_hash = ?', (file_hash,)).fetchone()
+    return dict(row) if row else None
+
+def record_import(file_hash, file_name, saved, skipped, db_path="bibliotek.db"):
+    """Remember a completed import of a file"""
+    with db.connection(db_path, 'record_import') as conn:
+        conn.execute('INSERT OR REPLACE INTO imports VALUES (?, ?, ?, ?, ?)',
+                     (file_hash, file_name, datetime.now().isoformat(timespec='seconds'), saved, skipped))
+
+# Import functions
+INGEST_CHUNK_SIZE = 1 << 20
+MAX_RECORD_SIZE = 64 << 20
+JSON_WHITESPACE = re.compile(r'[ \t\r\n]*')
+
+def file_hash(fileobj, chunk_size=INGEST_CHUNK_SIZE):
+    """SHA-256 of a binary file object, read in chunks; leaves it rewound"""
+    fileobj.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def iter_json_array(fileobj, chunk_size=INGEST_CHUNK_SIZE, progress=None):
+    """Yield the elements of a top-level JSON array one at a time
+
+    Reads the binary file object in chunks and decodes one element at a time,
+    so memory holds one chunk and one element rather than the whole array.
+    `progress` is called with the number of bytes read after each chunk.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8-sig')()
+    buf, pos, eof, bytes_read = '', 0, False, 0
+
+    def fill():
+        nonlocal buf, pos, eof, bytes_read
+        chunk = fileobj.read(chunk_size)
+        eof = not chunk
+        bytes_read += len(chunk)
+        buf = buf[pos:] + text.decode(chunk, final=eof)
+        pos = 0
+        if progress:
+            progress(bytes_read)
+
+    def next_char():
+        nonlocal pos
+        while True:
+            pos = JSON_WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            fill()
+
+    def end_of_array():
+        # Only whitespace may follow the array, e.g. not a second dump
+        nonlocal pos
+        pos += 1
+        if next_char():
+            raise ValueError(f"Ugyldig JSON etter {bytes_read - len(buf) + pos} byte: mer data etter listen")
+
+    if next_char() != '[':
+        raise ValueError("Filen må inneholde en JSON-liste med bibliotek")
+    pos += 1
+    if next_char() == ']':
+        end_of_array()
+        return
+    
+    while True:
+        next_char()
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                end = None
+            # Only accept an element followed by a delimiter, since a number
+            # cut off at the end of the buffer would still parse
+            if end is not None and (eof or end < len(buf) and buf[end] in ' \t\r\n,]'):
+                break
+            if eof or len(buf) - pos > MAX_RECORD_SIZE:
+                raise ValueError(f"Ugyldig JSON etter {bytes_read - len(buf) + pos} byte")
+            fill()
+        pos = end
+        yield item
+        
+        separator = next_char()
+        if separator == ']':
+            end_of_array()
+            return
+        if separator != ',':
+            raise ValueError(f"Ugyldig JSON etter {bytes_read - len(buf) + pos} byte")
+        pos += 1
+
+def validate_library(lib):
+    """Why a record can't be imported, or None if it is valid"""
+    if not isinstance(lib, dict):
+        return "ikke et JSON-objekt"
+    if not isinstance(lib.get('bibnr'), str) or not lib['bibnr']:
+        return "mangler bibnr"
+    if lib.get('kommnr') is not None and not isinstance(lib['kommnr'], dict):
+        return "kommnr er ikke et objekt"
+    for field in CHILD_TABLES:
+        items = lib.get(field)
+        if items is not None and not (isinstance(items, list) and all(isinstance(item, dict) for item in items)):
+            return f"{field} er ikke en liste med objekter"
+    return None
+
+@timed_stage()
+def ingest_json(fileobj, db_path="bibliotek.db", file_name=None, batch_size=SAVE_BATCH_SIZE, progress=None):
+    """Stream a JSON array of libraries from a binary file object into the database
+
+    Records are validated as they are read and saved in batches; invalid ones
+    are skipped and reported. A file whose content hash was imported before
+    is not read again. `progress` is called with (bytes read, total bytes).
+    Returns a report with the counts, the first errors and any earlier import.
+    """
+    total = fileobj.seek(0, os.SEEK_END)
+    digest = file_hash(fileobj)
+    report = {'file_hash': digest, 'saved': 0, 'skipped': 0, 'errors': [], 'previous': get_import(digest, db_path)}
+    if report['previous']:
+        return report
+    
+    def valid_libraries():
+        on_chunk = (lambda done: progress(done, total)) if progress else None
+        for i, lib in enumerate(iter_json_array(fileobj, progress=on_chunk), start=1):
+            error = validate_library(lib)
+            if error:
+                report['skipped'] += 1
+                if len(report['errors']) < 10:
+                    report['errors'].append(f"Post {i}: {error}")
+                continue
+            yield lib
+    
+    report['saved'] = save_to_database(valid_libraries(), db_path, batch_size)
+    record_import(digest, file_name, report['saved'], report['skipped'], db_path)
+    return report
+
+# API functions
+API_URL = "https://www.nb.no/basebibliotek/rest/bibnr/{bibnr}"
+API_MAX_WORKERS = 16
+API_RATE_LIMIT = 100.0  # requests per second, shared by all workers
+API_TIMEOUT = (5, 30)
+
+class RateLimiter:
+    """Thread-safe limiter that spaces out request starts evenly"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+def create_api_session(max_workers=API_MAX_WORKERS, retries=3, backoff=0.5):
+    """Create a pooled requests session with retry and exponential backoff"""
+    requests = load_module('requests')
+    Retry = load_module('urllib3.util.retry').Retry
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+        respect_retry_after_header=True
+    )
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers, max_retries=retry)
+
+    session = requests.Session()
+    session.headers.update({'Accept': 'application/json'})
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def fetch_library(session, bibnr, limiter=None, validators=None):
+    """Fetch a single library record from BaseBibliotek
+
+    Sends If-None-Match/If-Modified-Since when `validators` holds a stored
+    ETag or Last-Modified value. Returns (record, etag, last_modified), with
+    record set to None when the server answers 304 Not Modified.
+    """
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+    if limiter:
+        limiter.wait()
+
+    response = session.get(API_URL.format(bibnr=bibnr), headers=headers, timeout=API_TIMEOUT)
+    etag = response.headers.get('ETag')
+    last_modified = response.headers.get('Last-Modified')
+    if response.status_code == 304:
+        return None, etag, last_modified
+    response.raise_for_status()
+
+    data = response.json()
+    if isinstance(data, list):
+        data = data[0] if data else None
+    if not data:
+        raise ValueError(f"Tomt svar for {bibnr}")
+    return data, etag, last_modified
+
+@timed_stage()
+def fetch_libraries(bibnr_list, max_workers=API_MAX_WORKERS, rate_limit=API_RATE_LIMIT, progress_callback=None, sync_state=None):
+    """Fetch many library records concurrently over one shared session
+
+    At most `max_workers` requests are in flight at once, and request starts
+    are spaced to stay under `rate_limit` requests per second. When
+    `sync_state` (from `load_sync_state`) is given, requests are conditional.
+    Returns a dict with the fetched `records`, the bibnr values that were
+    `not_modified`, the `validators` (etag, last_modified) per bibnr and
+    `errors` mapping bibnr to an error message.
+    """
+    bibnr_list = list(dict.fromkeys(str(bibnr) for bibnr in bibnr_list))
+    total = len(bibnr_list)
+    sync_state = sync_state or {}
+    result = {'records': [], 'not_modified': [], 'validators': {}, 'errors': {}}
+
+    limiter = RateLimiter(rate_limit)
+    with create_api_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(fetch_library, session, bibnr, limiter, sync_state.get(bibnr)): bibnr
+            for bibnr in bibnr_list
+        }
+
+        try:
+            for done, future in enumerate(as_completed(futures), start=1):
+                bibnr = futures[future]
+                try:
+                    record, etag, last_modified = future.result()
+                except Exception as e:
+                    result['errors'][bibnr] = str(e)
+                else:
+                    result['validators'][bibnr] = (etag, last_modified)
+                    if record is None:
+                        result['not_modified'].append(bibnr)
+                    else:
+                        result['records'].append(record)
+
+                if progress_callback:
+                    progress_callback(done, total)
+        except BaseException:
+            # E.g. a cancelled job: drop the requests that haven't started
+            for future in futures:
+                future.cancel()
+            raise
+
+    return result
+
+# Helper functions
+
+# DataFrame columns copied from top-level record fields
+DATAFRAME_FIELDS = {
+    'rid': 'rid',
+    'bibnr': 'bibnr',
+    'bibliotek_full': 'inst',
+    'biblioteksystem': 'katsyst',
+    'bibliotektype': 'bibltype',
+    'adresse': 'vadr',
+    'postnr': 'vpostnr',
+    'poststed': 'vpoststed',
+    'epost': 'epostAdr',
+    'telefon': 'tlf',
+    'nettside': 'urlHjem',
+    'katalog': 'urlKat',
+    'lat_lon': 'lat_lon',
+    'orgnr': 'orgnr',
+    'bibleder': 'bibleder',
+    'isil': 'isil'
+}
+CATEGORY_COLUMNS = ['bibliotektype', 'biblioteksystem', 'fylke_nr', 'kommune_navn']
+LAT_LON_PATTERN = r'^\s*(?P<lat>[^,]*?)\s*,\s*(?P<lon>[^,]*?)\s*(?:,|$)'
+FLOAT_PATTERN = r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$'
+
+def arrow_strings(values):
+    """Arrow string array of values; anything that isn't a string becomes null"""
+    try:
+        return pa.array(values, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return pa.array([value if isinstance(value, str) else None for value in values], type=pa.string())
+
+def arrow_floats(strings):
+    """Cast an Arrow string array to float64, with unparseable values as null"""
+    numeric = pc.match_substring_regex(strings, FLOAT_PATTERN)
+    return pc.cast(pc.if_else(numeric, strings, pa.scalar(None, pa.string())), pa.float64())
+
+def parse_lat_lon_column(lat_lon):
+    """Vectorized parse_lat_lon: a 'lat, lon' column into nullable Float64 lat and lon"""
+    coords = pc.extract_regex(arrow_strings(lat_lon), LAT_LON_PATTERN)
+    lat = arrow_floats(pc.struct_field(coords, 'lat'))
+    lon = arrow_floats(pc.struct_field(coords, 'lon'))
+    valid = pc.and_(pc.is_valid(lat), pc.is_valid(lon))
+    missing = pa.scalar(None, pa.float64())
+    return (pd.Series(pc.if_else(valid, lat, missing), index=lat_lon.index, dtype='Float64'),
+            pd.Series(pc.if_else(valid, lon, missing), index=lat_lon.index, dtype='Float64'))
+
+@timed_stage()
+def json_to_dataframe(data):
+    """Convert JSON data to pandas DataFrame
+
+    Built column by column: string parsing runs as pyarrow compute kernels,
+    lat/lon are nullable Float64 and the facet columns are categoricals.
+    """
+    data = data if isinstance(data, list) else list(data)
+    df = pd.DataFrame(data, columns=list(DATAFRAME_FIELDS.values()))
+    df.columns = list(DATAFRAME_FIELDS)
+    
+    # Fields missing from every record come back as float NaN
+    for column in df.columns[df.dtypes == float]:
+        if df[column].isna().all():
+            df[column] = np.full(len(df), None, dtype=object)
+    
+    # Placed after bibliotektype, as in the original record loop
+    kommnr = [lib.get('kommnr') or {} for lib in data]
+    df.insert(5, 'kommunenr', [k.get('kommnr') for k in kommnr])
+    df.insert(6, 'kommune_navn', [k.get('navn') for k in kommnr])
+    
+    first_line = pc.list_element(pc.split_pattern(arrow_strings(df['bibliotek_full']), '\n', max_splits=1), 0)
+    df.insert(2, 'bibliotek', first_line.to_pandas().fillna('').to_numpy())
+    
+    df['lat'], df['lon'] = parse_lat_lon_column(df['lat_lon'])
+    
+    fylke_nr = pc.utf8_slice_codeunits(arrow_strings(df['kommunenr']), 0, 2).to_pandas()
+    df['fylke_nr'] = fylke_nr.where(fylke_nr != '').to_numpy()
+    
+    for column in CATEGORY_COLUMNS:
+        df[column] = df[column].astype('category')
+    
+    return df
+
+FYLKE_MAPPING = {
+    '03': 'Oslo', '11': 'Rogaland', '15': 'Møre og Romsdal', '18': 'Nordland',
+    '32': 'Akershus', '31': 'Østfold', '33': 'Buskerud', '34': 'Innlandet', '39': 'Vestfold', '40': 'Telemark',
+    '42': 'Agder', '46': 'Vestland', '50': 'Trøndelag', '55': 'Troms', '56': 'Finnmark',
+}
+
+def get_fylke_name(fylke_nr):
+    return FYLKE_MAPPING.get(fylke_nr, f"Fylke {fylke_nr}")
+
+@timed_stage()
+def rank_search_hits(df, hits):
+    """Rows of df whose bibnr is in hits, in the order of hits"""
+    rank = {bibnr: i for i, bibnr in enumerate(hits)}
+    return df[df['bibnr'].isin(list(rank))].sort_values('bibnr', key=lambda col: col.map(rank))
+
+@timed_stage()
+def rank_substring_hits(df, query):
+    """Rows whose name, bibnr, kommune or poststed contain the query, best match first
+
+    Used when SQLite lacks FTS5. An exact bibnr ranks above a name starting
+    with the query, which ranks above a name containing it, which ranks above
+    a kommune or poststed match.
+    """
+    query = query.strip().lower()
+    name = df['bibliotek'].str.lower()
+    score = (8 * (df['bibnr'] == query)
+             + 4 * name.str.startswith(query, na=False)
+             + 2 * name.str.contains(query, regex=False, na=False)
+             + df['bibnr'].str.contains(query, regex=False, na=False)
+             + df['kommune_navn'].astype(object).str.lower().str.contains(query, regex=False, na=False)
+             + df['poststed'].str.lower().str.contains(query, regex=False, na=False))
+    score = score.fillna(0).astype(int)
+    return df[score > 0].iloc[np.argsort(-score[score > 0].to_numpy(), kind='stable')]
+
+def patch_row(df, position, row):
+    """Overwrite the row at `position` in place with the single-row frame `row`"""
+    # Scalar .at assignment writes into the column; .iloc copies the column
+    label = df.index[position]
+    for column in df.columns:
+        value = row[column].iloc[0]
+        if isinstance(df[column].dtype, pd.CategoricalDtype) and pd.notna(value) \
+                and value not in df[column].cat.categories:
+            df[column] = df[column].cat.add_categories([value])
+        df.at[label, column] = value
+
+# Filter engine
+FILTER_FACETS = ['fylke_nr', 'bibliotektype', 'biblioteksystem']
+
+class FilterEngine:
+    """Precomputed per-value row masks for the sidebar facets of one frame
+
+    Any combination of facet selections is answered by OR-ing and AND-ing
+    the masks, without scanning the frame; recent combinations are kept in
+    an LRU cache.
+    """
+
+    @timed_stage('build_filter_engine')
+    def __init__(self, df, cache_size=128):
+        self.df = df
+        self.masks = {facet: self._value_masks(df[facet]) for facet in FILTER_FACETS}
+        self.options = {facet: self._options(facet) for facet in FILTER_FACETS}
+        self._combine = functools.lru_cache(maxsize=cache_size)(self._combine_masks)
+
+    @staticmethod
+    def _value_masks(column):
+        codes = column.cat.codes.to_numpy()
+        return {value: codes == code for code, value in enumerate(column.cat.categories)}
+
+    def _options(self, facet):
+        return sorted(value for value, mask in self.masks[facet].items() if mask.any())
+
+    def mask(self, fylke_nr=None, bibliotektyper=(), biblioteksystemer=()):
+        """Boolean row mask for a selection; empty selections don't filter"""
+        return self._combine(fylke_nr, frozenset(bibliotektyper), frozenset(biblioteksystemer))
+
+    def _combine_masks(self, fylke_nr, bibliotektyper, biblioteksystemer):
+        none = np.zeros(len(self.df), dtype=bool)
+        mask = np.ones(len(self.df), dtype=bool)
+        if fylke_nr:
+            mask &= self.masks['fylke_nr'].get(fylke_nr, none)
+        for facet, values in [('bibliotektype', bibliotektyper), ('biblioteksystem', biblioteksystemer)]:
+            if values:
+                mask &= np.logical_or.reduce([self.masks[facet].get(value, none) for value in values])
+        # Cached results are shared between sessions
+        mask.setflags(write=False)
+        return mask
+
+    def update_row(self, position, old_values, new_values):
+        """Move one row between value masks after an in-place edit"""
+        for facet in FILTER_FACETS:
+            old, new = old_values[facet], new_values[facet]
+            if old == new or (pd.isna(old) and pd.isna(new)):
+                continue
+            if pd.notna(old):
+                self.masks[facet][old][position] = False
+            if pd.notna(new):
+                self.masks[facet].setdefault(new, np.zeros(len(self.df), dtype=bool))[position] = True
+            self.options[facet] = self._options(facet)
+        self._combine.cache_clear()
+
+# Spatial index
+EARTH_RADIUS_KM = 6371.0088
+
+def haversine_km(lat, lon, lats, lons):
+    """Great-circle distance in km from one point to arrays of points"""
+    lat, lon, lats, lons = np.radians(lat), np.radians(lon), np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+class SpatialIndex:
+    """Grid index over the library coordinates for radius, nearest and bbox queries
+
+    Points are bucketed into cells of `cell_deg` degrees, so a query only
+    computes distances to the points in the cells its search circle touches.
+    Results are row positions in the frame the index was built from.
+    """
+
+    @timed_stage('build_spatial_index')
+    def __init__(self, df, cell_deg=0.25):
+        self.df = df
+        self.cell_deg = cell_deg
+        self.lon_cells = int(np.ceil(360 / cell_deg))
+        has_coords = (df['lat'].notna() & df['lon'].notna()).to_numpy()
+        self.positions = np.flatnonzero(has_coords)
+        self.lat = df['lat'].to_numpy(dtype='float64', na_value=np.nan)[self.positions]
+        self.lon = df['lon'].to_numpy(dtype='float64', na_value=np.nan)[self.positions]
+        
+        # Sort points by cell so each cell is one contiguous slice
+        keys = self._cell(self.lat, self.lon)
+        order = np.argsort(keys, kind='stable')
+        self.positions, self.lat, self.lon = self.positions[order], self.lat[order], self.lon[order]
+        cells, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+        self.cells = {int(cell): slice(start, start + count) for cell, start, count in zip(cells, starts, counts)}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _cell(self, lat, lon):
+        row = np.floor((np.asarray(lat) + 90) / self.cell_deg).astype(np.int64)
+        col = np.floor((np.asarray(lon) + 180) / self.cell_deg).astype(np.int64) % self.lon_cells
+        return row * self.lon_cells + col
+
+    def _candidates(self, lat, lon, radius_km):
+        """Indexes of the points in all cells that can lie within radius_km"""
+        lat_span = np.degrees(radius_km / EARTH_RADIUS_KM)
+        cos_lat = np.cos(np.radians(min(abs(lat) + lat_span, 90)))
+        lon_span = 180 if cos_lat < 1e-6 else min(lat_span / cos_lat, 180)
+        rows = range(int((max(lat - lat_span, -90) + 90) // self.cell_deg),
+                     int((min(lat + lat_span, 90) + 90) // self.cell_deg) + 1)
+        first_col = int((lon - lon_span + 180) // self.cell_deg)
+        cols = range(first_col, min(int((lon + lon_span + 180) // self.cell_deg), first_col + self.lon_cells - 1) + 1)
+        if len(rows) * len(cols) >= len(self.cells):
+            return np.arange(len(self.positions))
+        slices = [self.cells[key] for key in (row * self.lon_cells + col % self.lon_cells for row in rows for col in cols)
+                  if key in self.cells]
+        if not slices:
+            return np.arange(0)
+        return np.concatenate([np.arange(cell.start, cell.stop) for cell in slices])
+
+    def within(self, lat, lon, radius_km):
+        """Positions and distances of all libraries within radius_km, nearest first"""
+        candidates = self._candidates(lat, lon, radius_km)
+        distances = haversine_km(lat, lon, self.lat[candidates], self.lon[candidates])
+        inside = distances <= radius_km
+        candidates, distances = candidates[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return self.positions[candidates[order]], distances[order]
+
+    def nearest(self, lat, lon, k=5):
+        """Positions and distances of the k libraries nearest to a point"""
+        # Widen the search circle until it holds k points; the k nearest
+        # overall are then the k nearest inside it
+        radius_km = self.cell_deg * 111
+        while True:
+            positions, distances = self.within(lat, lon, radius_km)
+            if len(positions) >= k or radius_km >= np.pi * EARTH_RADIUS_KM:
+                return positions[:k], distances[:k]
+            radius_km *= 2
+
+    def nearest_to(self, position, k=5):
+        """k libraries nearest to the library at `position`, excluding itself"""
+        lat, lon = self.df['lat'].iloc[position], self.df['lon'].iloc[position]
+        if pd.isna(lat) or pd.isna(lon):
+            return np.arange(0), np.arange(0.0)
+        positions, distances = self.nearest(lat, lon, k + 1)
+        keep = positions != position
+        return positions[keep][:k], distances[keep][:k]
+
+    def within_to(self, position, radius_km):
+        """Libraries within radius_km of the library at `position`, excluding itself"""
+        lat, lon = self.df['lat'].iloc[position], self.df['lon'].iloc[position]
+        if pd.isna(lat) or pd.isna(lon):
+            return np.arange(0), np.arange(0.0)
+        positions, distances = self.within(lat, lon, radius_km)
+        keep = positions != position
+        return positions[keep], distances[keep]
+
+    def bbox(self, south, west, north, east):
+        """Boolean row mask of the libraries inside a bounding box"""
+        mask = np.zeros(len(self.df), dtype=bool)
+        inside = (self.lat >= south) & (self.lat <= north)
+        if west <= east:
+            inside &= (self.lon >= west) & (self.lon <= east)
+        else:
+            inside &= (self.lon >= west) | (self.lon <= east)
+        mask[self.positions[inside]] = True
+        return mask
+
+    def nearest_frame(self, positions, distances):
+        """Query result as a table of libraries with their distance in km"""
+        result = self.df.iloc[positions][['bibnr', 'bibliotek', 'bibliotektype', 'kommune_navn', 'poststed']].copy()
+        result['avstand_km'] = np.round(distances, 2)
+        return result
+
+# Statistics
+STATS_DIMENSIONS = ['fylke_nr', 'kommunenr', 'kommune_navn', 'bibliotektype', 'biblioteksystem']
+
+class StatsCube:
+    """Library counts per (fylke, kommune, type, system) cell
+
+    Built once per data version; a filter selection and every breakdown in
+    the overview are answered by summing the matching cells instead of
+    scanning the frame. Selections and breakdowns are memoized and shared
+    between sessions, so callers must not modify them.
+    """
+
+    def __init__(self, cells, df=None):
+        self.cells = cells
+        self.df = df
+        self._memo = {}
+        self._select = functools.lru_cache(maxsize=64)(self._select_cells)
+
+    @classmethod
+    @timed_stage('build_stats_cube')
+    def from_frame(cls, df):
+        cells = df.groupby(STATS_DIMENSIONS, observed=True, dropna=False, sort=False).agg(
+            antall=('bibnr', 'size'),
+            med_koordinater=('lat', 'count')
+        )
+        return cls(cells.reset_index(), df)
+
+    def _memoized(self, key, compute):
+        if key not in self._memo:
+            self._memo[key] = compute()
+        return self._memo[key]
+
+    def select(self, fylke_nr=None, bibliotektyper=(), biblioteksystemer=()):
+        """Cube of the cells matching a sidebar selection; empty selections don't filter"""
+        return self._select(fylke_nr, frozenset(bibliotektyper), frozenset(biblioteksystemer))
+
+    def _select_cells(self, fylke_nr, bibliotektyper, biblioteksystemer):
+        mask = np.ones(len(self.cells), dtype=bool)
+        if fylke_nr:
+            mask &= (self.cells['fylke_nr'] == fylke_nr).to_numpy()
+        if bibliotektyper:
+            mask &= self.cells['bibliotektype'].isin(bibliotektyper).to_numpy()
+        if biblioteksystemer:
+            mask &= self.cells['biblioteksystem'].isin(biblioteksystemer).to_numpy()
+        return StatsCube(self.cells[mask])
+
+    def summary(self):
+        return self._memoized('summary', lambda: {
+            'antall': int(self.cells['antall'].sum()),
+            'bibliotektyper': self.cells['bibliotektype'].nunique(),
+            'biblioteksystemer': self.cells['biblioteksystem'].nunique(),
+            'med_koordinater': int(self.cells['med_koordinater'].sum())
+        })
+
+    def counts(self, column):
+        """Number of libraries per value of a dimension, largest first"""
+        def compute():
+            counts = self.cells.groupby(column, observed=True)['antall'].sum()
+            return counts[counts > 0].sort_values(ascending=False)
+        return self._memoized(('counts', column), compute)
+
+    def by_fylke(self):
+        def compute():
+            counts = self.counts('fylke_nr').copy()
+            counts.index = [get_fylke_name(fylke_nr) for fylke_nr in counts.index]
+            return counts
+        return self._memoized('by_fylke', compute)
+
+    def by_kommune(self):
+        """Libraries and libraries with coordinates per kommune, largest first"""
+        def compute():
+            table = self.cells.groupby(['kommunenr', 'kommune_navn', 'fylke_nr'], observed=True)[['antall', 'med_koordinater']].sum()
+            table = table[table['antall'] > 0].sort_values('antall', ascending=False).reset_index()
+            table['fylke_nr'] = table['fylke_nr'].map(get_fylke_name)
+            return table
+        return self._memoized('by_kommune', compute)
+
+    def market_share(self):
+        """Share of each library system within each library type, in percent"""
+        def compute():
+            counts = self.cells.groupby(['bibliotektype', 'biblioteksystem'], observed=True)['antall'].sum().unstack(fill_value=0)
+            return counts.div(counts.sum(axis=1), axis=0) * 100
+        return self._memoized('market_share', compute)
+
+# Shared dataset
+class SharedDataset:
+    """Process-wide DataFrame of all libraries, shared read-only by every session
+
+    Reloaded from the database only when its data version has changed, so
+    memory stays flat as sessions are added and edits reach every session.
+    Callers must treat the frame as immutable.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.version = None
+        self.df = None
+        self.positions = {}
+        self._filters = None
+        self._spatial = None
+        self._stats = None
+        # Bumped by every in-place patch of the frame
+        self.edits = 0
+
+    def get(self):
+        if get_data_version(self.db_path) != self.version:
+            with self.lock:
+                version = get_data_version(self.db_path)
+                if version != self.version:
+                    self.df = self._load(version)
+                    self.positions = dict(zip(self.df['bibnr'], range(len(self.df)))) if self.df is not None else {}
+                    self.version = version
+        return self.df
+
+    @timed_stage('load_dataset')
+    def _load(self, version):
+        """Frame at `version` from the snapshot, or parsed from the JSON (refreshing the snapshot)"""
+        df = load_snapshot(self.db_path, version)
+        if df is None:
+            data = load_from_database(self.db_path)
+            if not data:
+                return None
+            df = json_to_dataframe(data)
+            write_snapshot(df, version, self.db_path)
+        return df
+
+    def apply_edit(self, record, version):
+        """Patch one edited library into the frame in place instead of reloading
+
+        Only applies when `version` directly follows the loaded version, so no
+        other change can be missed; otherwise the next get() reloads as usual.
+        """
+        with self.lock:
+            position = self.positions.get(record.get('bibnr'))
+            if position is None or self.version is None or version != self.version + 1:
+                return False
+            row = json_to_dataframe([record])
+            columns = list(dict.fromkeys(FILTER_FACETS + STATS_DIMENSIONS + ['lat', 'lon']))
+            old_values = self.df.iloc[position][columns]
+            new_values = row.iloc[0][columns]
+            patch_row(self.df, position, row)
+            self.edits += 1
+            if self._filters is not None and self._filters.df is self.df:
+                self._filters.update_row(position, old_values, new_values)
+            # Cheap to rebuild; the next spatial() and stats() calls do so
+            if not old_values[['lat', 'lon']].equals(new_values[['lat', 'lon']]):
+                self._spatial = None
+            if not old_values[STATS_DIMENSIONS + ['lat']].equals(new_values[STATS_DIMENSIONS + ['lat']]):
+                self._stats = None
+            self.version = version
+            return True
+
+    def _derived(self, name, df, build):
+        """Structure built by build(df), kept in self.<name> while `df` is the current frame
+
+        Built outside the lock, so sessions aren't blocked meanwhile. If an
+        edit patched the frame during the build, the result may have missed
+        it, so it is built again under the lock before it is kept.
+        """
+        current = getattr(self, name)
+        if current is not None and current.df is df:
+            return current
+        with self.lock:
+            edits = self.edits
+        result = build(df)
+        with self.lock:
+            if df is self.df:
+                if self.edits != edits:
+                    result = build(df)
+                setattr(self, name, result)
+        return result
+
+    def filters(self, df):
+        """FilterEngine for `df` as returned by get(), built once per version"""
+        return self._derived('_filters', df, FilterEngine)
+
+    def spatial(self, df):
+        """SpatialIndex for `df` as returned by get(), rebuilt when coordinates change"""
+        return self._derived('_spatial', df, SpatialIndex)
+
+    def stats(self, df):
+        """StatsCube for `df` as returned by get(), rebuilt when an edit changes its cells"""
+        return self._derived('_stats', df, StatsCube.from_frame)
+
+# Map functions
+MAP_FIELDS = ['lat', 'lon', 'bibliotek', 'bibliotektype', 'biblioteksystem', 'poststed']
+
+# Markers and popups are created in the browser from the point rows; the
+# popup HTML is only built when a marker is clicked
+MAP_MARKER_CALLBACK = """
+function (row) {
+    var escape = function (value) {
+        return String(value === null ? '' : value).replace(/[&<>"']/g, function (c) {
+            return {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'}[c];
+        });
+    };
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {
+        icon: L.AwesomeMarkers.icon({icon: 'book', prefix: 'fa', markerColor: 'blue'})
+    });
+    marker.bindTooltip(escape(row[2]));
+    marker.bindPopup(function () {
+        return '<b>' + escape(row[2]) + '</b><br>Type: ' + escape(row[3]) +
+            '<br>System: ' + escape(row[4]) + '<br>' + escape(row[5]);
+    }, {maxWidth: 250});
+    return marker;
+}
+"""
+
+def map_points(df_filtered):
+    """Rows with coordinates, as plain floats and strings for the map layers"""
+    df_map = df_filtered.loc[df_filtered['lat'].notna() & df_filtered['lon'].notna(), MAP_FIELDS]
+    points = pd.DataFrame({
+        'lat': df_map['lat'].to_numpy(dtype='float64'),
+        'lon': df_map['lon'].to_numpy(dtype='float64')
+    })
+    for col in MAP_FIELDS[2:]:
+        values = df_map[col].astype(object)
+        points[col] = values.where(values.notna(), None).to_numpy()
+    return points
+
+@timed_stage()
+def create_map(points):
+    """Clustered folium map of the points, or None if there are none"""
+    if len(points) == 0:
+        return None
+    
+    folium = load_module('folium')
+    FastMarkerCluster = load_module('folium.plugins').FastMarkerCluster
+    m = folium.Map(location=[points['lat'].mean(), points['lon'].mean()], zoom_start=6, tiles='OpenStreetMap')
+    FastMarkerCluster(points.to_numpy().tolist(), callback=MAP_MARKER_CALLBACK).add_to(m)
+    
+    return m
+
+@timed_stage()
+def create_deck(points):
+    """pydeck scatterplot of the points, used when folium is not installed"""
+    pdk = load_module('pydeck')
+    layer = pdk.Layer(
+        'ScatterplotLayer',
+        data=points,
+        get_position='[lon, lat]',
+        get_fill_color=[31, 119, 180, 200],
+        get_radius=400,
+        radius_min_pixels=3,
+        pickable=True
+    )
+    view = pdk.ViewState(latitude=points['lat'].mean(), longitude=points['lon'].mean(), zoom=4.5)
+    tooltip = {'html': '<b>{bibliotek}</b><br>Type: {bibliotektype}<br>System: {biblioteksystem}<br>{poststed}'}
+    return pdk.Deck(layers=[layer], initial_view_state=view, tooltip=tooltip, map_style=None)
+
+# Export functions
+EXPORT_COLUMNS = ['bibnr', 'bibliotek', 'biblioteksystem', 'bibliotektype', 'kommunenr',
+                  'kommune_navn', 'fylke_nr', 'adresse', 'postnr', 'poststed',
+                  'epost', 'telefon', 'nettside', 'katalog', 'lat_lon', 'orgnr', 'bibleder', 'isil']
+EXPORT_CHUNK_SIZE = 10000
+EXPORT_SHEETS = {
+    'eressurser': 'Ressurser',
+    'altkoder': 'Alternative koder',
+    'merknader': 'Merknader'
+}
+
+def export_chunks(df):
+    """The export columns of df in chunks of plain Python values, None for missing"""
+    for start in range(0, len(df), EXPORT_CHUNK_SIZE):
+        chunk = df.iloc[start:start + EXPORT_CHUNK_SIZE][EXPORT_COLUMNS].astype(object)
+        yield chunk.where(chunk.notna(), None)
+
+@timed_stage()
+def write_excel(df, output, db_path=None):
+    """Stream df to an xlsx workbook; with db_path, add one sheet per child table"""
+    # Write-only workbooks keep only the current row in memory
+    wb = load_module('openpyxl').Workbook(write_only=True)
+    ws = wb.create_sheet('Bibliotekdata')
+    ws.append(EXPORT_COLUMNS)
+    for chunk in export_chunks(df):
+        for row in chunk.itertuples(index=False, name=None):
+            ws.append(row)
+    
+    if db_path:
+        for table, title in EXPORT_SHEETS.items():
+            ws = wb.create_sheet(title)
+            ws.append(['bibnr'] + CHILD_TABLES[table])
+            for row in iter_child_rows(table, df['bibnr'], db_path):
+                ws.append(row)
+    
+    wb.save(output)
+
+@timed_stage()
+def write_csv(df, output, db_path=None):
+    """Stream df to UTF-8 CSV with a BOM so Excel reads æøå correctly"""
+    text = TextIOWrapper(output, encoding='utf-8-sig', newline='')
+    df[EXPORT_COLUMNS].to_csv(text, index=False, chunksize=EXPORT_CHUNK_SIZE)
+    text.detach()
+
+@timed_stage()
+def write_parquet(df, output, db_path=None):
+    """Stream df to Parquet, one row group per chunk"""
+    pq = load_module('pyarrow.parquet')
+    # One schema for the whole frame: a chunk where a column is empty would
+    # otherwise type it as null
+    schema = pa.Schema.from_pandas(df[EXPORT_COLUMNS], preserve_index=False)
+    for i, name in enumerate(schema.names):
+        if df[name].dtype == object:
+            schema = schema.set(i, pa.field(name, pa.string()))
+    with pq.ParquetWriter(output, schema) as writer:
+        for start in range(0, len(df), EXPORT_CHUNK_SIZE):
+            chunk = df.iloc[start:start + EXPORT_CHUNK_SIZE][EXPORT_COLUMNS]
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+# Format name: (writer, file extension, MIME type, supports full records)
+EXPORT_FORMATS = {
+    'Excel': (write_excel, 'xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', True),
+    'CSV': (write_csv, 'csv', 'text/csv', False),
+    'Parquet': (write_parquet, 'parquet', 'application/vnd.apache.parquet', False)
+}
+
+# Background jobs
+JOB_WORKERS = 2
+JOB_PROGRESS_INTERVAL = 0.5  # seconds between progress writes
+# Every runner touches its active jobs this often; an active job that hasn't
+# been touched for JOB_STALE_SECONDS belongs to a process that has died
+JOB_HEARTBEAT_SECONDS = 5
+JOB_STALE_SECONDS = 30
+ACTIVE_JOB_STATES = ('queued', 'running')
+
+class JobCancelled(Exception):
+    """Raised inside a running job once cancellation has been requested"""
+
+class JobContext:
+    """Progress reporting and cancellation checks for one running job"""
+
+    def __init__(self, job_id, db_path):
+        self.job_id = job_id
+        self.db_path = db_path
+        self.last_write = 0.0
+
+    def progress(self, fraction, message=None, force=False):
+        """Store the progress (0-1) at most every JOB_PROGRESS_INTERVAL; raises JobCancelled"""
+        now = time.monotonic()
+        if not force and now - self.last_write < JOB_PROGRESS_INTERVAL:
+            return
+        self.last_write = now
+        with db.connection(self.db_path, 'job_progress') as conn:
+            conn.execute('UPDATE jobs SET progress = ?, message = COALESCE(?, message), updated_at = ? WHERE id = ?',
+                         (min(max(fraction, 0.0), 1.0), message, datetime.now().isoformat(timespec='seconds'), self.job_id))
+            cancel_requested = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (self.job_id,)).fetchone()[0]
+        if cancel_requested:
+            raise JobCancelled()
+
+def job_spool_path(db_path, name):
+    """Where a job's input file is kept until the job has run"""
+    return os.path.join(f"{db_path}.jobs", name)
+
+def run_import_job(job, path, file_name):
+    """Ingest a spooled JSON upload; the spool file is removed afterwards"""
+    def progress(done, total):
+        job.progress(done / total if total else 1.0, f"Leser JSON... {done / 1e6:.0f} av {total / 1e6:.0f} MB")
+    
+    try:
+        with open(path, 'rb') as fileobj:
+            return ingest_json(fileobj, job.db_path, file_name, progress=progress)
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def run_sync_job(job, bibnr_list, max_workers, rate_limit, incremental, remove_missing):
+    """Fetch libraries from the API and write them, as in the API view"""
+    started = time.perf_counter()
+    fetched = fetch_libraries(
+        bibnr_list,
+        max_workers=max_workers,
+        rate_limit=rate_limit,
+        progress_callback=lambda done, total: job.progress(done / total, f"Hentet {done} av {total}"),
+        sync_state=load_sync_state(job.db_path) if incremental else None
+    )
+    job.progress(1.0, "Skriver til databasen...", force=True)
+    
+    result = {'incremental': incremental, 'remove_missing': remove_missing, 'errors': fetched['errors']}
+    if incremental:
+        result['report'] = sync_to_database(fetched, bibnr_list, job.db_path, remove_missing=remove_missing)
+    else:
+        result['saved'] = save_to_database(fetched['records'], job.db_path) if fetched['records'] else 0
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+# Job kind: function called with a JobContext and the job's params
+JOB_FUNCTIONS = {
+    'import': run_import_job,
+    'sync': run_sync_job
+}
+
+class JobRunner:
+    """Runs jobs from the jobs table on a small thread pool in this process
+
+    Jobs outlive the reruns and sessions that started them: their state is
+    in the database, so any session can follow or cancel them. A job with
+    the same key as a queued or running job is not started again; the
+    existing job is returned instead, also across processes.
+    """
+
+    def __init__(self, db_path, max_workers=JOB_WORKERS):
+        self.db_path = db_path
+        self.runner_id = f"{os.getpid()}:{id(self)}"
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='bibliotek-job')
+        threading.Thread(target=self.heartbeat, name='bibliotek-job-heartbeat', daemon=True).start()
+
+    def heartbeat(self):
+        """Keep this runner's active jobs from looking stale, also while a job doesn't report"""
+        while True:
+            time.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                with db.connection(self.db_path, 'job_heartbeat') as conn:
+                    conn.execute("UPDATE jobs SET updated_at = ? WHERE runner = ? AND status IN ('queued', 'running')",
+                                 (datetime.now().isoformat(timespec='seconds'), self.runner_id))
+            except sqlite3.Error:
+                pass
+
+    def submit(self, kind, params, key):
+        """Queue a job unless one with the same key is active; returns (job id, newly created)"""
+        now = datetime.now().isoformat(timespec='seconds')
+        with db.connection(self.db_path, 'submit_job') as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            expire_stale_jobs(conn)
+            row = conn.execute("SELECT id FROM jobs WHERE job_key = ? AND status IN ('queued', 'running')", (key,)).fetchone()
+            if row:
+                return row[0], False
+            job_id = conn.execute('''INSERT INTO jobs (kind, job_key, params, status, runner, created_at, updated_at)
+                                     VALUES (?, ?, ?, 'queued', ?, ?, ?)''',
+                                  (kind, key, encode_json(params), self.runner_id, now, now)).lastrowid
+        self.executor.submit(self.run, job_id, kind, params)
+        return job_id, True
+
+    def submit_import(self, fileobj, file_name):
+        """Queue the import of a JSON upload, keyed by its content hash"""
+        digest = file_hash(fileobj)
+        active = active_job(f"import:{digest}", self.db_path)
+        if active:
+            return active, False
+        
+        # The upload only lives as long as its session, so the job reads a copy
+        path = job_spool_path(self.db_path, f"{digest}.json")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fileobj.seek(0)
+        with open(f"{path}.{self.runner_id.replace(':', '_')}.tmp", 'wb') as spool:
+            for chunk in iter(lambda: fileobj.read(INGEST_CHUNK_SIZE), b''):
+                spool.write(chunk)
+        os.replace(spool.name, path)
+        return self.submit('import', {'path': path, 'file_name': file_name}, f"import:{digest}")
+
+    def submit_sync(self, bibnr_list, max_workers=API_MAX_WORKERS, rate_limit=API_RATE_LIMIT,
+                    incremental=True, remove_missing=False):
+        """Queue an API sync, keyed by its bibnr list and options"""
+        bibnr_list = sorted(set(str(bibnr) for bibnr in bibnr_list))
+        options = (incremental, remove_missing)
+        key = f"sync:{hashlib.sha256(encode_json([bibnr_list, options]).encode()).hexdigest()}"
+        return self.submit('sync', {'bibnr_list': bibnr_list, 'max_workers': max_workers, 'rate_limit': rate_limit,
+                                    'incremental': incremental, 'remove_missing': remove_missing}, key)
+
+    def run(self, job_id, kind, params):
+        now = datetime.now().isoformat(timespec='seconds')
+        with db.connection(self.db_path, 'start_job') as conn:
+            started = conn.execute('''UPDATE jobs SET status = 'running', started_at = ?, updated_at = ?
+                                      WHERE id = ? AND status = 'queued' AND NOT cancel_requested''',
+                                   (now, now, job_id)).rowcount
+        if not started:
+            return
+        
+        result = error = None
+        try:
+            result = JOB_FUNCTIONS[kind](JobContext(job_id, self.db_path), **params)
+        except JobCancelled:
+            status = 'cancelled'
+        except Exception as e:
+            status, error = 'failed', str(e)
+        else:
+            status = 'done'
+        
+        now = datetime.now().isoformat(timespec='seconds')
+        with db.connection(self.db_path, 'finish_job') as conn:
+            conn.execute('''UPDATE jobs SET status = ?, progress = CASE WHEN ? = 'done' THEN 1 ELSE progress END,
+                                            result = ?, error = ?, finished_at = ?, updated_at = ?
+                            WHERE id = ?''',
+                         (status, status, encode_json(result) if result is not None else None, error, now, now, job_id))
+
+def expire_stale_jobs(conn):
+    """Mark active jobs whose runner has stopped its heartbeat as failed"""
+    now = datetime.now()
+    stale_before = (now - timedelta(seconds=JOB_STALE_SECONDS)).isoformat(timespec='seconds')
+    conn.execute('''UPDATE jobs SET status = 'failed', error = ?, finished_at = ?
+                    WHERE status IN ('queued', 'running') AND updated_at < ?''',
+                 ("Jobben stoppet uten å fullføre", now.isoformat(timespec='seconds'), stale_before))
+
+def active_job(key, db_path="bibliotek.db"):
+    """Id of the queued or running job with this key, or None"""
+    with db.connection(db_path, 'active_job') as conn:
+        expire_stale_jobs(conn)
+        row = conn.execute("SELECT id FROM jobs WHERE job_key = ? AND status IN ('queued', 'running')", (key,)).fetchone()
+    return row[0] if row else None
+
+def get_job(job_id, db_path="bibliotek.db"):
+    """A job with its params and result decoded, or None"""
+    with db.connection(db_path, 'get_job') as conn:
+        c = conn.cursor()
+        c.row_factory = sqlite3.Row
+        row = c.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    if row is None:
+        return None
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+def cancel_job(job_id, db_path="bibliotek.db"):
+    """Ask a job to stop; a queued job is cancelled at once, a running one at its next progress report
+
+    A job whose runner has died is finished at once as well.
+    """
+    now = datetime.now()
+    stale_before = (now - timedelta(seconds=JOB_STALE_SECONDS)).isoformat(timespec='seconds')
+    with db.connection(db_path, 'cancel_job') as conn:
+        conn.execute('UPDATE jobs SET cancel_requested = 1 WHERE id = ?', (job_id,))
+        conn.execute('''UPDATE jobs SET status = 'cancelled', finished_at = ?
+                        WHERE id = ? AND (status = 'queued' OR status = 'running' AND updated_at < ?)''',
+                     (now.isoformat(timespec='seconds'), job_id, stale_before))
+
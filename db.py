@@ -0,0 +1,150 @@
+"""Pooled SQLite connections for the library database
+
+Every database function in core.py borrows a connection from the pool of its
+database file instead of opening its own. Pooled connections are opened once
+with the same pragmas and keep sqlite3's prepared statement cache between
+calls, and each borrow is timed per operation name.
+"""
+import collections
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+DB_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-65536',  # 64 MB
+    'PRAGMA temp_store=MEMORY'
+]
+POOL_SIZE = 8
+STATEMENT_CACHE_SIZE = 256
+SELECT_BATCH_SIZE = 500
+
+class QueryStats:
+    """Call count, total and maximum duration per named database operation"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, name, seconds):
+        with self.lock:
+            calls, total, longest = self.stats.get(name, (0, 0.0, 0.0))
+            self.stats[name] = (calls + 1, total + seconds, max(longest, seconds))
+
+    def summary(self):
+        """One row per operation, slowest total first, in milliseconds"""
+        with self.lock:
+            stats = dict(self.stats)
+        return sorted(({'operation': name, 'calls': calls, 'total_ms': total * 1000,
+                        'mean_ms': total / calls * 1000, 'max_ms': longest * 1000}
+                       for name, (calls, total, longest) in stats.items()),
+                      key=lambda row: row['total_ms'], reverse=True)
+
+class ConnectionPool:
+    """Up to `size` connections to one database file, each used by one thread at a time
+
+    Connections are created with check_same_thread=False because Streamlit
+    runs every session's script in its own thread; the pool makes sure a
+    connection is only borrowed by one of them at once. If the database file
+    is deleted or replaced, idle connections to the old file are dropped.
+    """
+
+    def __init__(self, db_path, size=POOL_SIZE):
+        self.db_path = db_path
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = collections.deque()
+        self.file_id = None
+        self.stats = QueryStats()
+
+    def current_file_id(self):
+        try:
+            stat = os.stat(self.db_path)
+        except OSError:
+            return None
+        return (stat.st_dev, stat.st_ino)
+
+    def open(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False,
+                               cached_statements=STATEMENT_CACHE_SIZE)
+        for pragma in DB_PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        file_id = self.current_file_id()
+        with self.lock:
+            if file_id != self.file_id:
+                while self.idle:
+                    self.idle.pop().close()
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = self.open()
+            file_id = self.current_file_id()
+        with self.lock:
+            self.file_id = file_id
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            self.idle.append(conn)
+
+    @contextmanager
+    def connection(self, name=None):
+        """Borrow a connection; an open transaction is committed on exit, or rolled back on error"""
+        self.slots.acquire()
+        started = time.perf_counter()
+        try:
+            conn = self.acquire()
+            try:
+                yield conn
+                if conn.in_transaction:
+                    conn.commit()
+            except BaseException:
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    conn.close()
+                    raise
+                self.release(conn)
+                raise
+            self.release(conn)
+        finally:
+            self.slots.release()
+            if name:
+                self.stats.record(name, time.perf_counter() - started)
+
+    def close(self):
+        """Close the idle connections; borrowed ones are closed when returned"""
+        with self.lock:
+            while self.idle:
+                self.idle.pop().close()
+
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+def get_pool(db_path="bibliotek.db"):
+    """The process-wide pool of a database file"""
+    key = os.path.abspath(db_path)
+    with POOLS_LOCK:
+        if key not in POOLS:
+            POOLS[key] = ConnectionPool(key)
+        return POOLS[key]
+
+def connection(db_path="bibliotek.db", name=None):
+    """Borrow a pooled connection to `db_path`, timed under `name`"""
+    return get_pool(db_path).connection(name)
+
+def select_in(conn, sql, keys, batch_size=SELECT_BATCH_SIZE):
+    """Run `sql` for `keys` in batches and yield the rows
+
+    `sql` has a single `{}` where the placeholders of the IN list go, e.g.
+    "SELECT bibnr, data FROM bibliotek WHERE bibnr IN ({})".
+    """
+    keys = list(keys)
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        yield from conn.execute(sql.format(', '.join('?' * len(batch))), batch)
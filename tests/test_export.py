@@ -0,0 +1,32 @@
+import io
+
+import pyarrow.parquet as pq
+
+import core
+
+def make_libraries(n, bibleder_from=0):
+    return [{
+        'rid': i + 1,
+        'bibnr': str(1000000 + i),
+        'inst': f'Bibliotek {i}',
+        'katsyst': 'Bibliofil',
+        'bibltype': 'FOLK',
+        'kommnr': {'kommnr': '0301', 'navn': 'Oslo'},
+        **({'bibleder': f'Leder {i}'} if i >= bibleder_from else {})
+    } for i in range(n)]
+
+def test_parquet_column_empty_in_first_chunk(monkeypatch):
+    monkeypatch.setattr(core, 'EXPORT_CHUNK_SIZE', 10)
+    df = core.json_to_dataframe(make_libraries(25, bibleder_from=10))
+    output = io.BytesIO()
+    core.write_parquet(df, output)
+    table = pq.read_table(io.BytesIO(output.getvalue()))
+    assert table.num_rows == 25
+    assert str(table.schema.field('bibleder').type) == 'string'
+    assert table.column('bibleder').to_pylist()[9:11] == [None, 'Leder 10']
+
+def test_parquet_empty_frame():
+    df = core.json_to_dataframe(make_libraries(1)).iloc[:0]
+    output = io.BytesIO()
+    core.write_parquet(df, output)
+    assert pq.read_table(io.BytesIO(output.getvalue())).num_rows == 0
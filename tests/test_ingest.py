@@ -0,0 +1,42 @@
+import io
+import json
+
+import pytest
+
+import core
+
+RECORDS = [{'bibnr': '1000001', 'inst': 'Tromsø bibliotek'}, 1.5, -20, None, True, 'streng', [], {}]
+
+def parse(data, chunk_size=core.INGEST_CHUNK_SIZE):
+    return list(core.iter_json_array(io.BytesIO(data), chunk_size=chunk_size))
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 7, 1 << 20])
+def test_chunk_boundaries(chunk_size):
+    data = json.dumps(RECORDS, ensure_ascii=False, indent=1).encode()
+    assert parse(data, chunk_size) == RECORDS
+
+def test_number_split_at_chunk_boundary():
+    assert parse(b'[12345,678]', chunk_size=3) == [12345, 678]
+
+def test_bom():
+    assert parse(b'\xef\xbb\xbf [1, 2]', chunk_size=2) == [1, 2]
+
+@pytest.mark.parametrize('data', [b'[]', b' [ ] ', b'[1]\n', b'[1]\r\n\t '])
+def test_whitespace_around_array(data):
+    assert parse(data, chunk_size=2) == ([] if b'1' not in data else [1])
+
+@pytest.mark.parametrize('data', [b'[1, 2', b'[1, 2,', b'[{"bibnr": "1"', b'[1 2]', b'', b'{"bibnr": "1"}'])
+def test_invalid_or_truncated(data):
+    with pytest.raises(ValueError):
+        parse(data, chunk_size=2)
+
+@pytest.mark.parametrize('data', [b'[1] trailing', b'[1][2]', b'[] x', b'[1],'])
+def test_trailing_data(data):
+    with pytest.raises(ValueError, match="mer data etter listen"):
+        parse(data, chunk_size=2)
+
+def test_progress_reports_bytes_read():
+    data = b'[1, 2, 3]'
+    seen = []
+    list(core.iter_json_array(io.BytesIO(data), chunk_size=4, progress=seen.append))
+    assert seen[-1] == len(data)